@@ -1,7 +1,133 @@
 class DataConfig:
-    # number of packets to recieve before the GUI is updated
+    # number of packets to recieve before the GUI is updated, at first:
+    # the solver thread adapts it to the rate the GUI takes the batches at
+    # (the worker processes keep it)
     BATCH_UPDATE_COUNT = 10  # how many steps per plot update?
+    MAX_BATCH_UPDATE_COUNT = 100
+    # seconds between the adaptations of the batch size
+    BATCH_ADAPT_INTERVAL = 0.5
+    # max messages waiting for the GUI, the solver waits when it's full
+    # and drops the trajectories of the batched results past half of it
+    RESULT_QUEUE_SIZE = 64
+    # seconds a message waits on a full queue before it's dropped, the GUI
+    # has stopped taking them (e.g. the window was closed). The run is
+    # aborted and its simulations reported as KILLED
+    RESULT_QUEUE_STATUS_TIMEOUT = 10
+    # max time in ms the GUI spends taking results off the queue per frame
+    GUI_DRAIN_BUDGET_MS = 8
+    # the redraw interval is this many times the time the last replot
+    # took, within the min and max interval in ms
+    GUI_REDRAW_LOAD = 3
+    GUI_MIN_REDRAW_INTERVAL_MS = 10
+    GUI_MAX_REDRAW_INTERVAL_MS = 500
     # max frequency in GHz for PIMM
     PIMM_MAX_FREQUENCY_GHZ = 60
-    # subsampling of trajectories
+    # zero pad the PIMM relaxation to a fast FFT length
+    PIMM_FAST_FFT_LENGTH = False
+    # (min, max) band in GHz where the PIMM spectrum is evaluated on a
+    # dense grid with a chirp-z zoom, None for the plain FFT bins
+    PIMM_ZOOM_BAND_GHZ = None
+    # number of frequencies of the zoomed band
+    PIMM_ZOOM_POINTS = 512
+    # max steps of a single run of the PIMM relaxation, longer ones are
+    # run in consecutive segments of that many steps, which bounds their
+    # memory. The spectrum is averaged over the segments, so its
+    # resolution is that of a single segment. 0 runs it at once
+    PIMM_STREAM_SEGMENT_STEPS = 0
+    # stop the PIMM relaxation once |dm/dt| of every layer is below
+    # this value in 1/s, e.g. 1e6. None always runs the full LLG_time
+    RELAXATION_DMDT_TOLERANCE = None
+    # number of chunks the relaxation is checked after
+    RELAXATION_CHUNKS = 10
+    # fraction of LLG_time always run, before the relaxation may stop
+    RELAXATION_MIN_TIME_FRACTION = 0.25
+    # number of strongest PIMM peaks kept per H point instead of
+    # the whole spectrum, 0 keeps the spectrum
+    PIMM_PEAKS = 0
+    # trajectories kept in the results, per simulation
+    # False keeps none
+    TRAJECTORY_KEEP = True
+    # keep every k-th time step
     TRAJECTORY_SUBSAMPLE = 2
+    # keep only the last N (subsampled) time steps, 0 keeps all
+    TRAJECTORY_LAST_STEPS = 0
+    # keep the trajectory of every k-th H point
+    TRAJECTORY_H_STRIDE = 1
+    TRAJECTORY_DTYPE = "float32"
+    # the H stride is increased until the kept trajectories fit
+    TRAJECTORY_MEMORY_BUDGET_MB = 512
+    # directory of the memory-mapped trajectory files, None keeps the
+    # trajectories in memory. A file is removed once its result is
+    # dropped (e.g. the simulation is re-run or reset), or PyMag exits.
+    TRAJECTORY_STORE_DIR = None
+    # number of worker processes for the queued simulations
+    # 1 runs them one after another in the solver thread
+    SIMULATION_WORKERS = 1
+    # the worker processes write the result rows to shared memory and
+    # only notify the solver thread, instead of pickling the results
+    SHARED_MEMORY_RESULTS = True
+    # number of contiguous segments the H sweep of a single simulation is
+    # split into, each run on a separate core. 1 runs the sweep serially.
+    # Only applies when SIMULATION_WORKERS is 1.
+    # Only pays off for well-damped stacks, relaxed by the end of LLG_time:
+    # otherwise the seeds miss the serial states at the segment boundaries
+    # and the sweep falls back to a serial run after the first boundary.
+    H_SWEEP_SEGMENTS = 1
+    # integration step multiplier of the relaxation pass seeding the segments
+    SEGMENT_COARSE_FACTOR = 10
+    # max distance between the seed and the serial magnetisation at a
+    # segment boundary before the segment is re-run
+    SEGMENT_BOUNDARY_TOLERANCE = 1e-2
+    # points added by the adaptive H sweep where the results change the
+    # most, 0 for the uniform sweep only
+    H_ADAPTIVE_POINTS = 0
+    # no points are added once every change between neighbours is below
+    # this fraction of the range of m, R or the PIMM peak over the sweep
+    H_ADAPTIVE_TOLERANCE = 0.05
+    # an interval of the coarse sweep is halved at most this many times
+    H_ADAPTIVE_MAX_DEPTH = 4
+    # run the SD-FMR frequency loop in a separate process,
+    # concurrently with the PIMM relaxation
+    CONCURRENT_PIMM_VSD = False
+    # run each SD-FMR frequency only until the driven response is
+    # periodic and demodulate a whole number of periods after that,
+    # instead of running the full LLG_time
+    VSD_CYCLE_LIMITED = False
+    # periods per steady state check
+    VSD_CHECK_PERIODS = 4
+    # max difference of m between successive periods at steady state
+    VSD_STEADY_STATE_TOLERANCE = 1e-3
+    # periods demodulated at steady state, at most twice as many are run
+    # to end on a whole integration step
+    VSD_DEMODULATION_PERIODS = 10
+    # SD-FMR frequencies run per H point, on a coarse grid and then where
+    # the DC or the first harmonic change the most, the other frequencies
+    # are interpolated. 0 runs all of them
+    VSD_ADAPTIVE_FREQUENCIES = 0
+    # drive all the SD-FMR frequencies at once with a multitone current
+    # (each tone with the amplitude I_rf) and demodulate every frequency
+    # from a single run per H point, valid while the response is linear
+    # and the tones are further apart than a few 1/LLG_time. The second
+    # harmonic of evenly spaced tones falls on the sums of the other tones,
+    # it's only indicative then
+    VSD_MULTITONE = False
+    # min number of SD-FMR frequencies driven as a multitone, fewer are run
+    # one by one: the multitone current is a Python callback evaluated at
+    # every integration step, a run costs about as much as 5 single tones
+    VSD_MULTITONE_MIN_TONES = 6
+
+    @classmethod
+    def snapshot(cls) -> dict:
+        """
+        Current values of the settings, to apply in a spawned process,
+        which would otherwise start from the defaults above
+        """
+        return {
+            name: value
+            for name, value in vars(cls).items() if name.isupper()
+        }
+
+    @classmethod
+    def restore(cls, snapshot: dict):
+        for name, value in snapshot.items():
+            setattr(cls, name, value)
@@ -0,0 +1,3 @@
+from .solver import run
+
+__all__ = ["run"]
@@ -0,0 +1,46 @@
+import json
+import os
+
+import click
+
+from pymag.config import DataConfig
+from pymag.engine.data_holders import Layer, SimulationInput, StimulusObject
+from pymag.engine.solver import run
+
+
+@click.command(help='Run a simulation without the GUI')
+@click.option('--layers',
+              '-l',
+              required=True,
+              type=click.Path(exists=True, dir_okay=False),
+              help='Layer parameters, tab separated as in '
+              'presets/defaultParameters.csv')
+@click.option('--stimulus',
+              '-s',
+              required=True,
+              type=click.Path(exists=True, dir_okay=False),
+              help='Stimulus json, as in presets/stimulus.json')
+@click.option('--output',
+              '-o',
+              required=True,
+              type=click.Path(),
+              help='Prefix of the exported csv files')
+@click.option('--segments',
+              default=DataConfig.H_SWEEP_SEGMENTS,
+              show_default=True,
+              help='Number of H sweep segments run in parallel')
+def run_headless(layers, stimulus, output, segments):
+    DataConfig.H_SWEEP_SEGMENTS = segments
+    with open(stimulus, "r") as f:
+        stimulus_object = StimulusObject.from_json(json.load(f))
+    simulation_input = SimulationInput(layers=Layer.from_csv(layers),
+                                       stimulus=stimulus_object)
+    result = run(simulation_input)
+    output_dir = os.path.dirname(output)
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+    result.to_csv(output)
+
+
+if __name__ == "__main__":
+    run_headless()
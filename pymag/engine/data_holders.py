@@ -1,7 +1,11 @@
 import json
 import os
+import tempfile
+import weakref
 from abc import ABC, abstractclassmethod, abstractmethod
-from dataclasses import dataclass
+from dataclasses import dataclass, fields
+from multiprocessing import shared_memory
+from multiprocessing.reduction import ForkingPickler
 from typing import Any, Dict, List
 
 import cmtj
@@ -11,8 +15,9 @@ from numpy.core.shape_base import vstack
 from pydantic import BaseModel
 from pydantic.types import Json
 
-from pymag.engine.utils import get_stimulus
-from pymag.gui.utils import unicode_subs
+from pymag.config import DataConfig
+from pymag.engine.utils import (SweepMode, get_stimulus, parse_vector,
+                                unicode_subs)
 
 
 class GUIObject(ABC):
@@ -108,68 +113,760 @@ class VoltageSpinDiodeData:
     SHarmonic: np.ndarray
     FHarmonic_phase: np.ndarray
     SHarmonic_phase: np.ndarray
+    # 1 where simulated, 0 where interpolated
+    simulated: np.ndarray = 1.
 
-    def merge_vsd(self, vsd_data: 'VoltageSpinDiodeData', axis: int):
-        self.DC = np.concatenate((self.DC, vsd_data.DC), axis=axis)
-        self.FHarmonic = np.concatenate((self.FHarmonic, vsd_data.FHarmonic),
-                                        axis=axis)
-        self.SHarmonic = np.concatenate((self.SHarmonic, vsd_data.SHarmonic),
-                                        axis=axis)
+    @classmethod
+    def empty(cls, rows: int, columns: int) -> 'VoltageSpinDiodeData':
+        """
+        (rows, columns) grid for every harmonic and phase,
+        H points along the rows and frequencies along the columns.
+        The cells are NaN until written.
+        """
+        return cls(**{
+            field.name: np.full((rows, columns), np.nan)
+            for field in fields(cls)
+        })
+
+    def write(self, row: int, column: int,
+              vsd_data: 'VoltageSpinDiodeData'):
+        """
+        Copy a single point vsd_data into the cell (row, column)
+        """
+        for field in fields(self):
+            getattr(self, field.name)[row,
+                                      column] = getattr(vsd_data, field.name)
+
+    def write_rows(self, start: int, vsd_data: 'VoltageSpinDiodeData'):
+        """
+        Copy the rows of vsd_data in place, starting at row start
+        """
+        for field in fields(self):
+            values = getattr(vsd_data, field.name)
+            getattr(self, field.name)[start:start + len(values)] = values
+
+    def interpolate_row(self, row: int, frequencies: List[float]):
+        """
+        Fill the cells of a row that weren't written by linear
+        interpolation over the frequency, and mark them as interpolated.
+        The phases are unwrapped before and wrapped back after.
+        """
+        written = ~np.isnan(self.simulated[row])
+        if written.all() or not written.any():
+            return
+        frequencies = np.asarray(frequencies)
+        for field in fields(self):
+            values = getattr(self, field.name)[row]
+            known = values[written]
+            if field.name.endswith("_phase"):
+                known = np.unwrap(known)
+            interpolated = np.interp(frequencies[~written],
+                                     frequencies[written], known)
+            if field.name.endswith("_phase"):
+                interpolated = np.angle(np.exp(1j * interpolated))
+            values[~written] = interpolated
+        self.simulated[row, ~written] = 0
+
+    def row(self, index: int) -> 'VoltageSpinDiodeData':
+        """
+        View of a single H point, over all frequencies
+        """
+        return VoltageSpinDiodeData(**{
+            field.name: getattr(self, field.name)[index]
+            for field in fields(self)
+        })
+
+    def column(self, index: int) -> 'VoltageSpinDiodeData':
+        """
+        View of a single frequency, over all H points
+        """
+        return VoltageSpinDiodeData(**{
+            field.name: getattr(self, field.name)[:, index]
+            for field in fields(self)
+        })
+
+    def rows(self, stop: int) -> 'VoltageSpinDiodeData':
+        """
+        View of the first stop rows
+        """
+        return VoltageSpinDiodeData(
+            **{
+                field.name: getattr(self, field.name)[:stop]
+                for field in fields(self)
+            })
+
+    def take(self, indices: List[int]) -> 'VoltageSpinDiodeData':
+        """
+        Copy of the rows at indices, in that order
+        """
+        return VoltageSpinDiodeData(
+            **{
+                field.name: getattr(self, field.name)[indices]
+                for field in fields(self)
+            })
 
-        self.FHarmonic_phase = np.concatenate(
-            (self.FHarmonic_phase, vsd_data.FHarmonic_phase), axis=axis)
-        self.SHarmonic_phase = np.concatenate(
-            (self.SHarmonic_phase, vsd_data.SHarmonic_phase), axis=axis)
+    def __setstate__(self, state: Dict[str, Any]):
+        if "simulated" not in state:
+            # pickled by an earlier version, every cell was simulated
+            state["simulated"] = np.ones(np.shape(state["DC"]))
+        self.__dict__.update(state)
 
     def to_csv(self, filename, index: List[str], columns: List[str]):
         for name, values in zip([
                 "DC", "First_harmonic", "Second_harmonic",
-                "First_harmonic_phase", "Second_harmonic_phase"
+                "First_harmonic_phase", "Second_harmonic_phase", "Simulated"
         ], [
                 self.DC, self.FHarmonic, self.SHarmonic, self.FHarmonic_phase,
-                self.SHarmonic_phase
+                self.SHarmonic_phase, self.simulated
         ]):
             df = pd.DataFrame(data=values, columns=columns, index=index)
             df.to_csv(f"{filename}_{name}.csv", index=True)
 
 
+@dataclass
+class TrajectoryPolicy:
+    """
+    Which parts of the m trajectories are kept in the results.
+    :param keep
+        False keeps no trajectories
+    :param time_subsample
+        keep every time_subsample-th time step
+    :param last_steps
+        keep only the last steps after subsampling, 0 keeps all
+    :param H_stride
+        keep the trajectory of every H_stride-th H point
+    :param dtype
+        dtype of the kept trajectories
+    :param memory_budget_mb
+        max memory of the kept trajectories of a single simulation,
+        H_stride is increased until they fit
+    """
+    keep: bool = True
+    time_subsample: int = 1
+    last_steps: int = 0
+    H_stride: int = 1
+    dtype: str = "float32"
+    memory_budget_mb: float = 512
+
+    @classmethod
+    def from_config(cls) -> 'TrajectoryPolicy':
+        return cls(keep=DataConfig.TRAJECTORY_KEEP,
+                   time_subsample=DataConfig.TRAJECTORY_SUBSAMPLE,
+                   last_steps=DataConfig.TRAJECTORY_LAST_STEPS,
+                   H_stride=DataConfig.TRAJECTORY_H_STRIDE,
+                   dtype=DataConfig.TRAJECTORY_DTYPE,
+                   memory_budget_mb=DataConfig.TRAJECTORY_MEMORY_BUDGET_MB)
+
+    def kept_steps(self, steps: int) -> int:
+        kept = len(range(0, steps, max(1, self.time_subsample)))
+        if self.last_steps:
+            kept = min(kept, self.last_steps)
+        return kept
+
+    def effective_H_stride(self, H_points: int, layers: int,
+                           steps: int) -> int:
+        """
+        H stride that keeps the trajectories of H_points within
+        the memory budget, 0 if not even a single one fits.
+        """
+        if not self.keep:
+            return 0
+        trajectory_bytes = layers * 3 * self.kept_steps(
+            steps) * np.dtype(self.dtype).itemsize
+        max_kept = int(self.memory_budget_mb * 1024**2 // trajectory_bytes)
+        if max_kept < 1:
+            return 0
+        return max(self.H_stride, 1, -(-H_points // max_kept))
+
+    def select(self, m_traj: np.ndarray) -> np.ndarray:
+        """
+        View of the kept time steps of a (layers, 3, steps) trajectory
+        """
+        kept = m_traj[..., ::max(1, self.time_subsample)]
+        if self.last_steps:
+            kept = kept[..., -self.last_steps:]
+        return kept
+
+    def apply(self, m_traj: np.ndarray) -> np.ndarray:
+        """
+        Copy of the kept part of a (layers, 3, steps) trajectory
+        """
+        return self.select(m_traj).astype(self.dtype)
+
+
+def _remove_file(filename: str):
+    try:
+        os.remove(filename)
+    except OSError:
+        pass
+
+
+def _rebuild(cls, state: Dict[str, Any]):
+    obj = cls.__new__(cls)
+    obj.__dict__.update(state)
+    return obj
+
+
+def _reduce_by_reference(obj):
+    """
+    Reduction between processes (ForkingPickler) of an object over
+    a file or a shared memory block, the data isn't copied
+    """
+    return _rebuild, (type(obj), obj._reference_state())
+
+
+# the trajectory stores whose file was created in this process
+_created_stores = weakref.WeakValueDictionary()
+
+
+def _rebuild_store(state: Dict[str, Any]):
+    """
+    A store sent back to the process that created its file is that
+    store, the file is kept as long as it's referenced
+    """
+    store = _created_stores.get(state["filename"])
+    if store is None:
+        return _rebuild(TrajectoryStore, state)
+    store.mark_filled(state["filled"])
+    return store
+
+
+def _reduce_store(store: 'TrajectoryStore'):
+    """
+    See _reduce_by_reference
+    """
+    return _rebuild_store, (store._reference_state(), )
+
+
+class TrajectoryStore:
+    """
+    Kept trajectories of a sweep in a memory-mapped .npy file,
+    written in place by the solver, wherever it runs, and read back
+    one H point at a time.
+    Sent to other processes as the file name only, and sent back to the
+    process that created the file, it's the store that did. Pickled
+    otherwise (e.g. exported), it's a copy of the filled rows, since the
+    file is removed once that store is collected.
+    """
+
+    def __init__(self, filename: str, H_points: int, H_stride: int):
+        self.filename = filename
+        self.H_points = H_points
+        self.H_stride = H_stride
+        # H points written so far
+        self.filled = 0
+        self._memmap = None
+
+    @classmethod
+    def create(cls, directory: str, H_points: int, H_stride: int,
+               shape: tuple, dtype: str) -> 'TrajectoryStore':
+        """
+        Allocate the file for the trajectories of every H_stride-th
+        of H_points, each of shape (layers, 3, steps).
+        The file is removed once the returned store is collected (e.g.
+        the simulation is re-run or reset), or the process exits.
+        """
+        os.makedirs(directory, exist_ok=True)
+        fd, filename = tempfile.mkstemp(prefix="pymag_trajectories_",
+                                        suffix=".npy",
+                                        dir=directory)
+        os.close(fd)
+        np.lib.format.open_memmap(filename,
+                                  mode="w+",
+                                  dtype=dtype,
+                                  shape=(-(-H_points // H_stride), *shape))
+        store = cls(filename, H_points=H_points, H_stride=H_stride)
+        weakref.finalize(store, _remove_file, filename)
+        _created_stores[filename] = store
+        return store
+
+    @property
+    def memmap(self) -> np.memmap:
+        if self._memmap is None:
+            self._memmap = np.load(self.filename, mmap_mode="r+")
+        return self._memmap
+
+    def write(self, H_indx: int, m_traj: np.ndarray):
+        row = self.memmap[H_indx // self.H_stride]
+        steps = min(row.shape[-1], m_traj.shape[-1])
+        row[..., :steps] = m_traj[..., :steps]
+        self.mark_filled(H_indx + 1)
+
+    def mark_filled(self, stop: int):
+        """
+        The H points up to stop were written, possibly by another process
+        """
+        self.filled = max(self.filled, stop)
+
+    def __len__(self) -> int:
+        return self.filled
+
+    def __iter__(self):
+        # __getitem__ never runs out, it's None past the filled points
+        return (self[H_indx] for H_indx in range(self.filled))
+
+    def __getitem__(self, H_indx: int) -> np.ndarray:
+        """
+        Trajectory of H point H_indx, None if it wasn't kept or written
+        """
+        if H_indx % self.H_stride or H_indx >= self.filled:
+            return None
+        return np.array(self.memmap[H_indx // self.H_stride])
+
+    def _reference_state(self) -> Dict[str, Any]:
+        state = self.__dict__.copy()
+        state["_memmap"] = None
+        return state
+
+    def __reduce__(self):
+        rows = -(-self.filled // self.H_stride)
+        state = {
+            "filename": None,
+            "H_points": self.H_points,
+            "H_stride": self.H_stride,
+            "filled": self.filled,
+            "_memmap": np.array(self.memmap[:rows])
+        }
+        return _rebuild, (TrajectoryStore, state)
+
+
+class SharedResultRows:
+    """
+    Result rows of a whole sweep in a multiprocessing.shared_memory
+    block, laid out by H index. A worker process writes the rows of its
+    partial results in place and the process that created the block
+    reads them there, only notifications go through the queue.
+    Pickled as the block name and layout only.
+    :param layout
+        array name -> (shape, dtype), the ResultHolder columns,
+        "<Rxx_vsd|Rxy_vsd>.<field>" and optionally "m_traj"
+    """
+
+    def __init__(self, name: str, layout: Dict[str, tuple],
+                 H_stride: int = 1):
+        self.name = name
+        self.layout = layout
+        self.H_stride = H_stride
+        self._shm = None
+        self._arrays = None
+
+    @staticmethod
+    def _offsets(layout: Dict[str, tuple]) -> Dict[str, int]:
+        offsets, offset = {}, 0
+        for name, (shape, dtype) in layout.items():
+            offsets[name] = offset
+            nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+            # keep every array 64 byte aligned
+            offset += -(-nbytes // 64) * 64
+        offsets[None] = offset
+        return offsets
+
+    @classmethod
+    def create(cls, layout: Dict[str, tuple],
+               H_stride: int = 1) -> 'SharedResultRows':
+        """
+        Allocate the zeroed block, it's released once the returned
+        object is collected or the process exits.
+        """
+        shm = shared_memory.SharedMemory(create=True,
+                                         size=max(1,
+                                                  cls._offsets(layout)[None]))
+        rows = cls(shm.name, layout, H_stride=H_stride)
+        rows._shm = shm
+        weakref.finalize(rows, shm.unlink)
+        return rows
+
+    @property
+    def arrays(self) -> Dict[str, np.ndarray]:
+        if self._arrays is None:
+            if self._shm is None:
+                self._shm = shared_memory.SharedMemory(name=self.name)
+            offsets = self._offsets(self.layout)
+            self._arrays = {
+                name: np.ndarray(shape,
+                                 dtype=dtype,
+                                 buffer=self._shm.buf,
+                                 offset=offsets[name])
+                for name, (shape, dtype) in self.layout.items()
+            }
+        return self._arrays
+
+    @property
+    def trajectory_store(self) -> 'TrajectoryStore':
+        if "m_traj" not in self.layout:
+            return None
+        return SharedTrajectoryStore(self)
+
+    def vsd(self, name: str) -> VoltageSpinDiodeData:
+        """
+        VSD grid of the sweep, None if there are no SD frequencies
+        """
+        if f"{name}.DC" not in self.layout:
+            return None
+        return VoltageSpinDiodeData(
+            **{
+                field.name: self.arrays[f"{name}.{field.name}"]
+                for field in fields(VoltageSpinDiodeData)
+            })
+
+    def write(self, H_indx: int, result: 'ResultHolder'):
+        """
+        Copy the single row of a partial result into the row H_indx.
+        Its trajectory goes to trajectory_store, through the solver.
+        """
+        for name in ResultHolder._columns:
+            self.arrays[name][H_indx] = getattr(result, name)[0]
+        for name in ("Rxx_vsd", "Rxy_vsd"):
+            vsd = self.vsd(name)
+            if vsd is not None:
+                vsd.write_rows(H_indx, getattr(result, name))
+
+    def close(self):
+        """
+        Detach this process from the block, the views are invalid after
+        """
+        self._arrays = None
+        if self._shm is not None:
+            self._shm.close()
+            self._shm = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_shm"] = None
+        state["_arrays"] = None
+        return state
+
+
+class SharedTrajectoryStore(TrajectoryStore):
+    """
+    TrajectoryStore over the "m_traj" array of SharedResultRows
+    """
+
+    def __init__(self, rows: SharedResultRows):
+        super().__init__(filename=None,
+                         H_points=len(rows.arrays["_m_avg"]),
+                         H_stride=rows.H_stride)
+        self.rows = rows
+
+    @property
+    def memmap(self) -> np.ndarray:
+        return self.rows.arrays["m_traj"]
+
+
+class SharedFlag:
+    """
+    A flag in a multiprocessing.shared_memory byte, set by the process
+    that created it and polled by the worker processes. Unlike an
+    Event, it can be passed along with a single task.
+    Pickled as the block name only.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._shm = None
+
+    @classmethod
+    def create(cls) -> 'SharedFlag':
+        """
+        Allocate the cleared flag, it's released once the returned
+        object is collected or the process exits.
+        """
+        shm = shared_memory.SharedMemory(create=True, size=1)
+        shm.buf[0] = 0
+        flag = cls(shm.name)
+        flag._shm = shm
+        weakref.finalize(flag, shm.unlink)
+        return flag
+
+    @property
+    def buf(self) -> memoryview:
+        if self._shm is None:
+            self._shm = shared_memory.SharedMemory(name=self.name)
+        return self._shm.buf
+
+    def set(self):
+        self.buf[0] = 1
+
+    def is_set(self) -> bool:
+        return bool(self.buf[0])
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_shm"] = None
+        return state
+
+
+ForkingPickler.register(TrajectoryStore, _reduce_store)
+ForkingPickler.register(SharedTrajectoryStore, _reduce_by_reference)
+
+
+class OrderedTrajectories:
+    """
+    Trajectories in the sweep order of the result rows
+    """
+
+    def __init__(self, trajectories, order: List[int]):
+        self.trajectories = trajectories
+        self.order = order
+
+    def __len__(self) -> int:
+        return len(self.order)
+
+    def __getitem__(self, row: int) -> np.ndarray:
+        return self.trajectories[self.order[row]]
+
+
+def filled_rows(name: str) -> property:
+    """
+    Read-only view of the filled rows of a preallocated column,
+    a copy in the sweep order if the rows are out of order
+    """
+
+    def getter(self: 'ResultHolder'):
+        rows = getattr(self, name)[:self.filled]
+        if self.row_order is None:
+            return rows
+        return rows[self.row_order]
+
+    return property(getter)
+
+
 class ResultHolder(GenericHolder):
+    """
+    Results of the sweep, one row per H point.
+    The columns are allocated for the whole sweep on the first merge
+    and filled in place, the public attributes (m_avg, PIMM, ...)
+    are views of the rows filled so far.
+    m_traj is a list with a trajectory, or None where it wasn't kept,
+    or the TrajectoryStore if the trajectories are kept on disk.
+    The columns of a simulation run in a worker process are its
+    SharedResultRows, see from_shared_rows.
+    PIMM_peaks holds (peaks, 3) frequency, amplitude and FWHM per row
+    in the peak-only PIMM mode, PIMM is empty then.
+    The rows are stored in the order they were merged. A partial result
+    with H_position (a point inserted by the adaptive sweep) is placed
+    there in the sweep order: row_order then lists the stored rows in
+    the sweep order, the views follow it and H_mag holds the H values
+    of the filled rows only.
+    """
+    _columns = ("_m_avg", "_PIMM", "_PIMM_peaks", "_Rx", "_Ry", "_Rz",
+                "_L2convergence_dm")
 
     def __init__(self, mode, H_mag, m_avg, m_traj, PIMM, PIMM_freqs, SD_freqs,
                  Rx, Ry, Rz, L2convergence_dm, Rxx_vsd: VoltageSpinDiodeData,
-                 Rxy_vsd: VoltageSpinDiodeData) -> None:
+                 Rxy_vsd: VoltageSpinDiodeData,
+                 trajectory_store: TrajectoryStore = None,
+                 PIMM_peaks: np.ndarray = None) -> None:
         self.mode = mode
         self.H_mag = H_mag
-        self.m_avg = np.expand_dims(m_avg, axis=0)
-
-        self.Rx = [Rx]
-        self.Ry = [Ry]
-        self.Rz = [Rz]
         self.SD_freqs = SD_freqs
-        self.PIMM = np.asarray(PIMM).reshape(1, -1)
         self.PIMM_freqs = PIMM_freqs
-        # make place for next ones
-        self.m_traj = np.expand_dims(m_traj, axis=0)
-        self.update_count = 1
-        self.Rxx_vsd = Rxx_vsd
-        self.Rxy_vsd = Rxy_vsd
-        self.L2convergence_dm = [L2convergence_dm]
+
+        self._m_avg = np.asarray(m_avg, dtype=float).reshape(1, -1)
+        self._m_traj = [m_traj]
+        self.trajectory_store = trajectory_store
+        self._PIMM = np.asarray(PIMM, dtype=np.float32).reshape(1, -1)
+        if PIMM_peaks is None:
+            PIMM_peaks = np.empty((0, 3))
+        self._PIMM_peaks = np.asarray(PIMM_peaks,
+                                      dtype=float)[np.newaxis].copy()
+        self._Rx = np.asarray([Rx], dtype=float)
+        self._Ry = np.asarray([Ry], dtype=float)
+        self._Rz = np.asarray([Rz], dtype=float)
+        self._L2convergence_dm = np.asarray([L2convergence_dm], dtype=float)
+        self._Rxx_vsd = Rxx_vsd
+        self._Rxy_vsd = Rxy_vsd
+        # fill cursor
+        self.filled = 1
+        self.capacity = 1
+        self.H_position = None
+        self.row_order = None
+
+    m_avg = filled_rows("_m_avg")
+
+    @property
+    def m_traj(self) -> List[np.ndarray]:
+        if self.trajectory_store is not None:
+            self.trajectory_store.mark_filled(self.filled)
+            trajectories = self.trajectory_store
+        else:
+            trajectories = self._m_traj[:self.filled]
+        if self.row_order is None:
+            return trajectories
+        return OrderedTrajectories(trajectories, self.row_order)
+    PIMM = filled_rows("_PIMM")
+    PIMM_peaks = filled_rows("_PIMM_peaks")
+    Rx = filled_rows("_Rx")
+    Ry = filled_rows("_Ry")
+    Rz = filled_rows("_Rz")
+    L2convergence_dm = filled_rows("_L2convergence_dm")
+
+    def filled_vsd(self, vsd: VoltageSpinDiodeData) -> VoltageSpinDiodeData:
+        if vsd is None:
+            return None
+        if self.row_order is None:
+            return vsd.rows(self.filled)
+        return vsd.rows(self.filled).take(self.row_order)
+
+    @property
+    def Rxx_vsd(self) -> VoltageSpinDiodeData:
+        return self.filled_vsd(self._Rxx_vsd)
+
+    @property
+    def Rxy_vsd(self) -> VoltageSpinDiodeData:
+        return self.filled_vsd(self._Rxy_vsd)
+
+    @classmethod
+    def from_shared_rows(cls,
+                         rows: SharedResultRows,
+                         mode,
+                         H_mag,
+                         PIMM_freqs,
+                         SD_freqs,
+                         trajectory_store: TrajectoryStore = None
+                         ) -> 'ResultHolder':
+        """
+        Empty result whose columns are the shared rows, read in place.
+        filled is advanced as the rows are written.
+        """
+        holder = cls.__new__(cls)
+        holder.mode = mode
+        holder.H_mag = H_mag
+        holder.SD_freqs = SD_freqs
+        holder.PIMM_freqs = PIMM_freqs
+        for name in cls._columns:
+            setattr(holder, name, rows.arrays[name])
+        capacity = len(rows.arrays["_m_avg"])
+        holder._m_traj = [None] * capacity
+        if trajectory_store is None:
+            trajectory_store = rows.trajectory_store
+        holder.trajectory_store = trajectory_store
+        holder._Rxx_vsd = rows.vsd("Rxx_vsd")
+        holder._Rxy_vsd = rows.vsd("Rxy_vsd")
+        # keeps the block alive
+        holder.shared_rows = rows
+        holder.filled = 0
+        holder.capacity = capacity
+        holder.H_position = None
+        holder.row_order = None
+        return holder
+
+    def drop_trajectories(self):
+        """
+        Free the trajectories kept in memory, the ones in
+        the trajectory store are kept
+        """
+        self._m_traj = [None] * len(self._m_traj)
+
+    def reserve(self, capacity: int):
+        """
+        Reallocate the columns for capacity rows, keeping the filled ones
+        """
+        for name in self._columns:
+            column = getattr(self, name)
+            reserved = np.empty((capacity, *column.shape[1:]),
+                                dtype=column.dtype)
+            reserved[:self.filled] = column[:self.filled]
+            setattr(self, name, reserved)
+        self._m_traj = self._m_traj[:self.filled] + [None] * (capacity -
+                                                             self.filled)
+        for name in ("_Rxx_vsd", "_Rxy_vsd"):
+            vsd: VoltageSpinDiodeData = getattr(self, name)
+            if vsd is not None:
+                reserved = VoltageSpinDiodeData.empty(capacity,
+                                                      vsd.DC.shape[1])
+                reserved.write_rows(0, vsd.rows(self.filled))
+                setattr(self, name, reserved)
+        self.capacity = capacity
 
     def merge_result(self, result: 'ResultHolder'):
-        self.PIMM = np.concatenate((self.PIMM, np.asarray(result.PIMM)),
-                                   axis=0)
-        self.m_avg = np.concatenate((self.m_avg, np.asarray(result.m_avg)),
-                                    axis=0)
-        self.m_traj = np.concatenate((self.m_traj, result.m_traj), axis=0)
-        # take 0 because Rx is an expanding list
-        self.Rx.append(result.Rx[0])
-        self.Ry.append(result.Ry[0])
-        self.Rz.append(result.Rz[0])
-        self.L2convergence_dm.append(result.L2convergence_dm[0])
-        if self.Rxx_vsd is not None:
-            self.Rxx_vsd.merge_vsd(result.Rxx_vsd, axis=0)
-            self.Rxy_vsd.merge_vsd(result.Rxy_vsd, axis=0)
-        self.update_count += result.update_count
+        start = self.filled
+        stop = start + result.filled
+        if stop > self.capacity:
+            # the whole sweep at once, unless it's exceeded
+            self.reserve(max(len(self.H_mag), 2 * self.capacity, stop))
+        for name in self._columns:
+            getattr(self, name)[start:stop] = getattr(result,
+                                                      name)[:result.filled]
+        self._m_traj[start:stop] = result._m_traj[:result.filled]
+        if self.trajectory_store is None:
+            self.trajectory_store = result.trajectory_store
+        for name in ("_Rxx_vsd", "_Rxy_vsd"):
+            vsd: VoltageSpinDiodeData = getattr(self, name)
+            if vsd is not None:
+                vsd.write_rows(start,
+                               getattr(result, name).rows(result.filled))
+        if result.H_position is not None and self.row_order is None:
+            self.row_order = list(range(start))
+            self.H_mag = list(self.H_mag[:start])
+        if self.row_order is not None:
+            # a single row, at its place in the sweep order
+            if result.H_position is None:
+                position, H = len(self.row_order), result.H_mag[start]
+            else:
+                position, H = result.H_position, result.H_mag[0]
+            self.row_order.insert(position, start)
+            self.H_mag.insert(position, H)
+        self.filled = stop
+
+    def _reference_state(self) -> Dict[str, Any]:
+        # only the filled rows are pickled or copied
+        state = self.__dict__.copy()
+        for name in self._columns:
+            state[name] = getattr(self, name)[:self.filled]
+        state["_m_traj"] = self._m_traj[:self.filled]
+        for name in ("_Rxx_vsd", "_Rxy_vsd"):
+            if state[name] is not None:
+                state[name] = state[name].rows(self.filled)
+        state["capacity"] = self.filled
+        return state
+
+    def __getstate__(self):
+        """
+        Plain arrays only, e.g. for the export: the trajectories are
+        copied out of the trajectory store and the store and the shared
+        rows are left behind. Between processes, the partial results
+        keep their store (see _reduce_by_reference).
+        """
+        state = self._reference_state()
+        if self.trajectory_store is not None:
+            # in the order of the stored rows
+            self.trajectory_store.mark_filled(self.filled)
+            state["_m_traj"] = [
+                self.trajectory_store[H_indx] for H_indx in range(self.filled)
+            ]
+            state["trajectory_store"] = None
+        state.pop("shared_rows", None)
+        return state
+
+    def __setstate__(self, state: Dict[str, Any]):
+        """
+        Also loads the pickles of the earlier layout (e.g. old
+        workspaces), whose columns were public lists or arrays of the
+        filled rows.
+        """
+        if "update_count" in state:
+            rows = len(state["Rx"])
+            upgraded = {
+                name: state[name]
+                for name in ("mode", "H_mag", "SD_freqs", "PIMM_freqs")
+            }
+            upgraded["_m_avg"] = np.asarray(state["m_avg"],
+                                            dtype=float).reshape(rows, -1)
+            upgraded["_PIMM"] = np.asarray(state["PIMM"],
+                                           dtype=np.float32).reshape(rows, -1)
+            for name in ("Rx", "Ry", "Rz", "L2convergence_dm"):
+                upgraded[f"_{name}"] = np.asarray(state[name], dtype=float)
+            upgraded["_m_traj"] = list(state["m_traj"])
+            upgraded["_Rxx_vsd"] = state["Rxx_vsd"]
+            upgraded["_Rxy_vsd"] = state["Rxy_vsd"]
+            upgraded["filled"] = upgraded["capacity"] = rows
+            upgraded["_PIMM_peaks"] = np.empty((rows, 0, 3))
+            upgraded["trajectory_store"] = None
+            upgraded["H_position"] = None
+            upgraded["row_order"] = None
+            state = upgraded
+        self.__dict__.update(state)
 
     def to_csv(self, filename) -> None:
         """
@@ -188,7 +885,7 @@ class ResultHolder(GenericHolder):
                 "Rx": self.Rx,
                 "Ry": self.Ry,
                 "Rz": self.Rz,
-                "H": self.H_mag
+                "H": self.H_mag[:self.filled]
             })
             dynamics.to_csv(filename + "_dynamics.csv", index=False)
         except Exception as e:
@@ -196,23 +893,40 @@ class ResultHolder(GenericHolder):
 
         try:
             self.Rxx_vsd.to_csv(filename=filename + "SD_Rxx",
-                                index=self.H_mag,
+                                index=self.H_mag[:self.filled],
                                 columns=self.SD_freqs)
         except Exception as e:
             print(f"Failed to export Rxx spin diode: {e}")
         try:
-            self.Rxy_vsd.to_csv(filename=filename + "SD_Rxx",
-                                index=self.H_mag,
+            self.Rxy_vsd.to_csv(filename=filename + "SD_Rxy",
+                                index=self.H_mag[:self.filled],
                                 columns=self.SD_freqs)
         except Exception as e:
             print(f"Failed to export Rxy spin diode: {e}")
         try:
             pimm = pd.DataFrame(data=self.PIMM,
-                                columns=self.PIMM_freqs[:self.PIMM.shape[1]],
-                                index=self.H_mag)
+                                columns=np.ravel(
+                                    self.PIMM_freqs)[:self.PIMM.shape[1]],
+                                index=self.H_mag[:self.filled])
             pimm.to_csv(filename + "_PIMM.csv", index=True)
         except Exception as e:
             print(f"Failed to export PIMM: {e}")
+        if self.PIMM_peaks.shape[1]:
+            try:
+                peaks = pd.DataFrame(
+                    data=self.PIMM_peaks.reshape(self.filled, -1),
+                    columns=[
+                        f"{name}_{i}"
+                        for i in range(self.PIMM_peaks.shape[1])
+                        for name in ("f", "amplitude", "FWHM")
+                    ],
+                    index=self.H_mag[:self.filled])
+                peaks.to_csv(filename + "_PIMM_peaks.csv", index=True)
+            except Exception as e:
+                print(f"Failed to export PIMM peaks: {e}")
+
+
+ForkingPickler.register(ResultHolder, _reduce_by_reference)
 
 
 class Layer(GenericHolder, GUIObject):
@@ -373,6 +1087,18 @@ class Layer(GenericHolder, GUIObject):
                 res[itm] = _itm
         return res
 
+    @staticmethod
+    def from_csv(filename) -> List['Layer']:
+        """
+        Read the layers from a tab separated file,
+        in the format of the GUI layer table
+        """
+        df: pd.DataFrame = pd.read_csv(filename, delimiter='\t')
+        return [
+            Layer.from_gui(**df_dict)
+            for df_dict in df.to_dict(orient="records")
+        ]
+
     @staticmethod
     def parse_list(str_list: str):
         actual_list = [
@@ -410,6 +1136,82 @@ class StimulusObject(BaseModel):
     def to_gui(self) -> Dict[str, Any]:
         return self.stimulus_json
 
+    @classmethod
+    def from_values(cls, values: Dict[str, Any],
+                    stimulus_json: Dict[str, Any]) -> 'StimulusObject':
+        """
+        Calculates the values necessary for calculation
+        from the stimulus fields, in the GUI units.
+        :param values
+            field name -> value, the selected item for the combo
+            fields and a bool for the binary ones
+        :param stimulus_json
+            stimulus in the json format, kept for restoring the GUI
+        """
+        mode = values["HMode"]
+        if mode == SweepMode.H:
+            steps = int(values["HSteps"])
+            back = values["HBack"]
+        elif mode == SweepMode.PHI:
+            steps = int(values["HPhiSteps"])
+            back = values["HPhiBack"]
+        elif mode == SweepMode.THETA:
+            steps = int(values["HThetaSteps"])
+            back = values["HThetaBack"]
+        else:
+            raise ValueError(f"Invalid mode: {mode}")
+        # convert H from kA/m -> A/m
+        H_sweep, sweep = get_stimulus(values["H"] * 1e3, values["HMin"] * 1e3,
+                                      values["HMax"] * 1e3, values["HTheta"],
+                                      values["HThetaMin"], values["HThetaMax"],
+                                      values["HPhi"], values["HPhiMin"],
+                                      values["HPhiMax"], steps, back, mode)
+        f_min = values["fmin"] * 1e9
+        f_max = values["fmax"] * 1e9
+        f_steps = int(values["fsteps"])
+        LLG_steps = int(values["LLGsteps"])
+        LLG_time = values["LLGtime"] / 1e9  # ns -> s
+        PIMM_delta_f = 1. / LLG_time
+        PIMM_freqs = np.arange(0, PIMM_delta_f * LLG_steps, step=PIMM_delta_f)
+        SD_freqs = np.linspace(f_min, f_max, f_steps)
+        spectrum_len = LLG_steps // 2
+        return cls(
+            mode=mode,
+            H_sweep=H_sweep.tolist(),
+            sweep=sweep.tolist(),
+            LLG_steps=LLG_steps,
+            LLG_time=LLG_time,
+            frequency_min=f_min,
+            frequency_max=f_max,
+            frequency_steps=f_steps,
+            I_rf=values["Iac"],
+            I_dc=values["Idc"],
+            I_dir=parse_vector(values["Idir"]),
+            V_dir=parse_vector(values["Vdir"]),
+            # PIMM and VSD
+            spectrum_len=spectrum_len,
+            SD_freqs=SD_freqs.tolist(),
+            PIMM_freqs=PIMM_freqs.tolist(),
+            PIMM_delta_f=PIMM_delta_f,
+            stimulus_json=stimulus_json)
+
+    @classmethod
+    def from_json(cls, stimulus_json: Dict[str, Any]) -> 'StimulusObject':
+        """
+        :param stimulus_json
+            stimulus in the presets/stimulus.json format
+        """
+        values = {}
+        for obj in stimulus_json["stimulus"]:
+            params = obj["params"]
+            if params["mode"] == "Combo":
+                values[obj["name"]] = params["item_list"][params["value"]]
+            elif params["mode"] == "Binary":
+                values[obj["name"]] = bool(params["value"])
+            else:
+                values[obj["name"]] = params["value"]
+        return cls.from_values(values, stimulus_json=stimulus_json)
+
 
 class SimulationInput(GenericHolder):
 
@@ -0,0 +1,1550 @@
+import itertools
+import multiprocessing as mp
+import queue
+import time
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, fields
+from functools import partial
+from typing import Callable, Dict, Iterable, List, Sequence
+
+import cmtj
+import numpy as np
+# import numba
+from scipy.fft import next_fast_len, rfft, rfftfreq
+from scipy.signal import ZoomFFT, find_peaks, peak_widths
+
+from pymag.config import DataConfig
+from pymag.engine.data_holders import (Layer, ResultHolder, SharedFlag,
+                                       SharedResultRows, SimulationInput,
+                                       StimulusObject, TrajectoryPolicy,
+                                       TrajectoryStore, VoltageSpinDiodeData)
+from pymag.engine.utils import (SimulationStatus, SweepMode,
+                                butter_lowpass_filter, harmonic_bins,
+                                mu0_x_gamma, split_sweep)
+
+
+def compute_vsd(frequency, dynamicR, integration_step,
+                dynamicI) -> VoltageSpinDiodeData:
+    return compute_vsd_channels(frequency=frequency,
+                                dynamicR=np.asarray(dynamicR)[np.newaxis],
+                                integration_step=integration_step,
+                                dynamicI=dynamicI)[0]
+
+
+def demodulate_harmonics(frequency,
+                         dynamicR,
+                         integration_step,
+                         dynamicI,
+                         harmonics: Sequence[int] = (1, 2),
+                         reference_steps: int = None,
+                         excitation_phase: float = 0.):
+    """
+    DC and harmonics of the spin diode voltage of several resistance
+    channels driven by the same current, with a single filter and
+    spectral pass over all of them.
+    :param dynamicR
+        (channels, time) resistances, e.g. stacked Rxx and Rxy
+    :param harmonics
+        orders of frequency demodulated
+    :param reference_steps
+        for a whole number of periods at steady state: the series is
+        taken as repeating over reference_steps, so that the DC and the
+        harmonic amplitudes match those of a full length run
+    :param excitation_phase
+        phase of the current at t = 0, removed from the harmonic phases
+    :returns
+        (channels,) DC, (channels, len(harmonics)) amplitudes and phases
+    """
+    SD = -dynamicI * dynamicR
+    fs = 1.0 / integration_step
+    amplitude_scale = 1.
+    if reference_steps is not None:
+        amplitude_scale = reference_steps / SD.shape[-1]
+        # every channel repeated along its own time axis
+        SD_tiled = np.take(SD,
+                           np.arange(reference_steps) % SD.shape[-1],
+                           axis=-1)
+        SD_dc = butter_lowpass_filter(SD_tiled, cutoff=10e6, fs=fs, order=3)
+    else:
+        SD_dc = butter_lowpass_filter(SD, cutoff=10e6, fs=fs, order=3)
+    # argmax in range of every harmonic
+    neighbourhood = harmonic_bins(frequency,
+                                  SD.shape[-1],
+                                  integration_step,
+                                  harmonics=harmonics,
+                                  neighbourhood=5)
+    spectrum = rfft(SD, axis=-1)[:, neighbourhood]
+    # the strongest bin, whatever the phase of the excitation
+    max_harmonics = np.take_along_axis(spectrum,
+                                       np.argmax(np.abs(spectrum),
+                                                 axis=-1)[..., np.newaxis],
+                                       axis=-1)[..., 0]
+    amplitude = amplitude_scale * np.abs(max_harmonics)
+    phase = np.angle(max_harmonics *
+                     np.exp(-1j * excitation_phase * np.asarray(harmonics)))
+    return np.mean(SD_dc, axis=-1), amplitude, phase
+
+
+def compute_vsd_channels(frequency,
+                         dynamicR,
+                         integration_step,
+                         dynamicI,
+                         reference_steps: int = None,
+                         excitation_phase: float = 0.
+                         ) -> List[VoltageSpinDiodeData]:
+    """
+    Spin diode data of the first and the second harmonic,
+    see demodulate_harmonics
+    :returns
+        VoltageSpinDiodeData for every channel
+    """
+    DC, amplitude, phase = demodulate_harmonics(
+        frequency,
+        dynamicR,
+        integration_step,
+        dynamicI,
+        harmonics=(1, 2),
+        reference_steps=reference_steps,
+        excitation_phase=excitation_phase)
+    return [
+        VoltageSpinDiodeData(DC=DC[i],
+                             FHarmonic=amplitude[i, 0],
+                             SHarmonic=amplitude[i, 1],
+                             FHarmonic_phase=phase[i, 0],
+                             SHarmonic_phase=phase[i, 1])
+        for i in range(len(DC))
+    ]
+
+
+# @numba.jit(nopython=True, parallel=False)
+def calculate_resistance(Rx0, Ry0, AMR, AHE, SMR, m, number_of_layers, l, w):
+    R_P = Rx0[0]
+    R_AP = Ry0[0]
+
+    if m.ndim == 2:
+        SxAll = np.zeros((number_of_layers, ))
+        SyAll = np.zeros((number_of_layers, ))
+
+    elif m.ndim == 3:
+        SxAll = np.zeros((number_of_layers, m.shape[2]))
+        SyAll = np.zeros((number_of_layers, m.shape[2]))
+
+    for i in range(0, number_of_layers):
+        w_l = w[i] / l[i]
+        SxAll[i] = 1 / (Rx0[i] + (AMR[i] * m[i, 0]**2 + SMR[i] * m[i, 1]**2))
+        SyAll[i] = 1 / (Ry0[i] + 0.5 * AHE[i] * m[i, 2] + (w_l) *
+                        (SMR[i] - AMR[i]) * m[i, 0] * m[i, 1])
+
+    Rx = 1 / np.sum(SxAll, axis=0)
+    Ry = 1 / np.sum(SyAll, axis=0)
+
+    if number_of_layers > 1:
+        Rz = R_P + ((R_AP - R_P) / 2) * (1 - np.sum(m[0, :] * m[1, :], axis=0))
+    else:
+        Rz = 0
+
+    return Rx, Ry, Rz
+
+
+class PIMMSpectrum:
+    """
+    Magnitude spectrum of the PIMM relaxation, set up once per
+    simulation since the length and the step are fixed.
+    Either the rfft bins up to DataConfig.PIMM_MAX_FREQUENCY_GHZ, or
+    with DataConfig.PIMM_ZOOM_BAND_GHZ, a chirp-z zoom evaluating
+    DataConfig.PIMM_ZOOM_POINTS frequencies inside that band.
+    """
+
+    def __init__(self, steps: int, int_step: float):
+        """
+        :param steps
+            length of the relaxation time series, shorter ones (a short
+            last segment, or a log cmtj ended a step early) are padded
+            with their last value
+        """
+        self.steps = steps
+        self.zoom = None
+        if DataConfig.PIMM_ZOOM_BAND_GHZ is not None:
+            f_min, f_max = (f * 1e9 for f in DataConfig.PIMM_ZOOM_BAND_GHZ)
+            self.zoom = ZoomFFT(steps, [f_min, f_max],
+                                m=DataConfig.PIMM_ZOOM_POINTS,
+                                fs=1. / int_step,
+                                endpoint=True)
+            self.freqs = np.linspace(f_min, f_max,
+                                     DataConfig.PIMM_ZOOM_POINTS)
+            return
+        self.n_fft = steps
+        if DataConfig.PIMM_FAST_FFT_LENGTH:
+            # zero padded
+            self.n_fft = next_fast_len(steps, real=True)
+        freqs = rfftfreq(self.n_fft, d=int_step)[:self.n_fft // 2]
+        stop = np.searchsorted(freqs,
+                               DataConfig.PIMM_MAX_FREQUENCY_GHZ * 1e9,
+                               side='right')
+        self.freqs = freqs[:stop]
+
+    def __call__(self,
+                 mixed: np.ndarray,
+                 out: np.ndarray = None) -> np.ndarray:
+        """
+        :param out
+            float32 array of len(freqs) the spectrum is written to,
+            a new one by default
+        """
+        if len(mixed) != self.steps:
+            mixed = np.pad(mixed[:self.steps],
+                           (0, max(0, self.steps - len(mixed))),
+                           mode="edge")
+        spectrum = out
+        if spectrum is None:
+            spectrum = np.empty(len(self.freqs), dtype=np.float32)
+        if self.zoom is not None:
+            np.abs(self.zoom(mixed), out=spectrum)
+        else:
+            np.abs(rfft(mixed, n=self.n_fft)[:len(self.freqs)],
+                   out=spectrum)
+        return spectrum
+
+
+def PIMM_peaks(pimm_spectrum, pimm_freqs, peaks: int) -> np.ndarray:
+    """
+    Strongest peaks of the PIMM spectrum. The frequency and the
+    amplitude are interpolated between the bins with a parabola.
+    :param peaks
+        number of peaks kept
+    :return (peaks, 3) array of the frequency, amplitude and FWHM,
+        sorted by amplitude, NaN rows if fewer peaks are found
+    """
+    spectrum = np.ravel(pimm_spectrum)
+    pimm_freqs = np.ravel(pimm_freqs)
+    delta_f = pimm_freqs[1] - pimm_freqs[0]
+    result = np.full((peaks, 3), np.nan)
+    indices, _ = find_peaks(spectrum)
+    if not len(indices):
+        return result
+    indices = indices[np.argsort(spectrum[indices])[::-1][:peaks]]
+    widths = peak_widths(spectrum, indices, rel_height=0.5)[0]
+    a, b, c = spectrum[indices - 1], spectrum[indices], spectrum[indices + 1]
+    curvature = a - 2 * b + c
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # flat tops stay at the bin
+        offset = np.where(curvature != 0, 0.5 * (a - c) / curvature, 0)
+    result[:len(indices), 0] = pimm_freqs[0] + (indices + offset) * delta_f
+    result[:len(indices), 1] = b - 0.25 * (a - c) * offset
+    result[:len(indices), 2] = widths * delta_f
+    return result
+
+
+def multitone_phases(tones: int) -> np.ndarray:
+    """
+    Schroeder phases, keep the peak of a sum of equal tones low
+    """
+    k = np.arange(1, tones + 1)
+    return -np.pi * k * (k - 1) / tones
+
+
+def multitone_waveform(frequencies: List[float], phases: np.ndarray,
+                       s_time: float,
+                       int_step: float) -> Callable[[float], float]:
+    """
+    Sum of unit sines, tabulated every half step up to s_time, so that
+    a cmtj custom driver only looks the value up.
+    """
+    t = np.arange(2 * round(s_time / int_step) + 3) * int_step / 2
+    table = np.zeros_like(t)
+    for frequency, phase in zip(frequencies, phases):
+        table += np.sin(2 * np.pi * frequency * t + phase)
+    table = table.tolist()
+    scale = 2 / int_step
+    return lambda time: table[round(time * scale)]
+
+
+def configure_VSD_excitation(frequency,
+                             org_layers_strs: List[str],
+                             org_layers: List[Layer],
+                             junction: cmtj.Junction,
+                             stimulus: StimulusObject,
+                             phase=0):
+    """
+    Decide what kind of excitation is present in the junction.
+    Set both Oersted field and current adequately.
+    Convert current to layer current density.
+    :param frequency
+        a single frequency, or a list of frequencies for a multitone
+        excitation of LLG_time, each tone with the amplitude I_rf
+    :param phase
+        phase of the excitation at t = 0 of the run, in radians,
+        one per tone for a multitone excitation
+    """
+    if np.ndim(frequency):
+        waveform = multitone_waveform(
+            frequency, phase, stimulus.LLG_time,
+            stimulus.LLG_time / stimulus.LLG_steps)
+
+        def scalar_driver(const, amp):
+            # a ScalarDriver only takes * float and + float (which adds
+            # to the amplitude too), not another driver, so the custom
+            # one carries both the constant and the amplitude
+            return cmtj.ScalarDriver.getCustomDriver(
+                lambda time: const + amp * waveform(time))
+    else:
+
+        def scalar_driver(const, amp):
+            return cmtj.ScalarDriver.getSineDriver(const, amp, frequency,
+                                                   phase)
+
+    HoeDrivers: List[cmtj.AxialDriver] = [
+        cmtj.AxialDriver(
+            scalar_driver(l.Hoe * stimulus.I_dc, l.Hoe * stimulus.I_rf),
+            scalar_driver(l.Hoe * stimulus.I_dc, l.Hoe * stimulus.I_rf),
+            scalar_driver(l.Hoe * stimulus.I_dc, l.Hoe * stimulus.I_dc))
+        for l in org_layers
+    ]
+    for i in range(len(org_layers)):
+        driver = HoeDrivers[i]
+        driver.applyMask(org_layers[i].Hoedir)
+        junction.setLayerOerstedFieldDriver(org_layers_strs[i], driver)
+        # for converting to current density
+        if stimulus.I_dir == [1, 0, 0]:
+            area = org_layers[i].w * org_layers[i].th
+        elif stimulus.I_dir == [0, 1, 0]:
+            area = org_layers[i].l * org_layers[i].th
+        else:
+            area = org_layers[i].w * org_layers[i].l * 1e-6 * 1e-6
+        junction.setLayerCurrentDriver(
+            org_layers_strs[i],
+            scalar_driver(stimulus.I_dc / area, stimulus.I_rf / area))
+
+
+@dataclass
+class SweepState:
+    """
+    Magnetisation carried from one H point to the next,
+    one [x, y, z] per layer for each of the chains.
+    """
+    m_PIMM: List[List[float]]
+    m_VSD: List[List[float]]
+
+
+def vector_to_list(vector: cmtj.CVector) -> List[float]:
+    return [vector.x, vector.y, vector.z]
+
+
+def build_junction(org_layers: List[Layer]) -> cmtj.Junction:
+    junction = cmtj.Junction(layers=[layer.to_cmtj() for layer in org_layers])
+    # assign IEC interacton
+    for i in range(len(org_layers) - 1):
+        junction.setIECDriver(
+            str(org_layers[i].layer), str(org_layers[i + 1].layer),
+            cmtj.ScalarDriver.getConstantDriver(org_layers[i].J))
+        junction.setQuadIECDriver(
+            str(org_layers[i].layer), str(org_layers[i + 1].layer),
+            cmtj.ScalarDriver.getConstantDriver(org_layers[i].J2))
+    return junction
+
+
+def resistance_parameters(org_layers: List[Layer]) -> Dict[str, np.ndarray]:
+    """
+    Layer parameters for calculate_resistance
+    """
+    return {
+        "Rx0": np.asarray([l.Rx0 for l in org_layers]),
+        "Ry0": np.asarray([l.Ry0 for l in org_layers]),
+        "SMR": np.asarray([l.SMR for l in org_layers]),
+        "AMR": np.asarray([l.AMR for l in org_layers]),
+        "AHE": np.asarray([l.AHE for l in org_layers]),
+        "w": np.asarray([l.w for l in org_layers]),
+        "l": np.asarray([l.l for l in org_layers]),
+        "number_of_layers": len(org_layers)
+    }
+
+
+def set_external_field(junction: cmtj.Junction, Hval: List[float]):
+    HDriver = cmtj.AxialDriver(cmtj.ScalarDriver.getConstantDriver(Hval[0]),
+                               cmtj.ScalarDriver.getConstantDriver(Hval[1]),
+                               cmtj.ScalarDriver.getConstantDriver(Hval[2]))
+    junction.setLayerExternalFieldDriver("all", HDriver)
+
+
+def configure_PIMM_excitation(junction: cmtj.Junction, int_step: float):
+    """
+    Short Oersted field pulse along z, no current.
+    """
+    HoeDriver = cmtj.AxialDriver(
+        cmtj.NullDriver(), cmtj.NullDriver(),
+        cmtj.ScalarDriver.getStepDriver(0, 50, 0.0, int_step * 3))
+    junction.setLayerOerstedFieldDriver("all", HoeDriver)
+    junction.setLayerCurrentDriver("all", cmtj.NullDriver())
+
+
+def switch_off_PIMM_excitation(junction: cmtj.Junction):
+    """
+    Every run restarts from t = 0, so the pulse is removed
+    before the relaxation is continued in another run.
+    """
+    junction.setLayerOerstedFieldDriver(
+        "all",
+        cmtj.AxialDriver(cmtj.NullDriver(), cmtj.NullDriver(),
+                         cmtj.NullDriver()))
+
+
+def relaxed(m: np.ndarray, int_step: float) -> bool:
+    """
+    Whether |dm/dt| of every layer, averaged over the last 100 steps,
+    is within DataConfig.RELAXATION_DMDT_TOLERANCE
+    :param m
+        (layers, 3, steps) trajectory
+    """
+    tail = m[..., -min(101, m.shape[-1]):]
+    dmdt = np.linalg.norm(np.diff(tail, axis=-1), axis=1) / int_step
+    return np.max(np.mean(dmdt,
+                          axis=-1)) <= DataConfig.RELAXATION_DMDT_TOLERANCE
+
+
+def sweep_points(stimulus: StimulusObject) -> int:
+    """
+    Points of the whole sweep, with those the adaptive sweep may add
+    """
+    return len(stimulus.H_sweep) + DataConfig.H_ADAPTIVE_POINTS
+
+
+def relaxation_steps(stimulus: StimulusObject) -> int:
+    """
+    Length of a single run of the PIMM relaxation, and of its trajectory
+    """
+    if not DataConfig.PIMM_STREAM_SEGMENT_STEPS:
+        return stimulus.LLG_steps
+    return min(stimulus.LLG_steps, DataConfig.PIMM_STREAM_SEGMENT_STEPS)
+
+
+def relaxation_segments(stimulus: StimulusObject) -> List[int]:
+    """
+    Steps of the consecutive runs of the PIMM relaxation, the remainder
+    of LLG_steps is run last
+    """
+    steps = relaxation_steps(stimulus)
+    segments = [steps] * (stimulus.LLG_steps // steps)
+    if stimulus.LLG_steps % steps:
+        segments.append(stimulus.LLG_steps % steps)
+    return segments
+
+
+def initial_magnetisation(org_layers: List[Layer],
+                          stimulus: StimulusObject) -> List[cmtj.CVector]:
+    m_init = []
+    for i in range(len(org_layers)):
+        # normally align with field
+        if np.linalg.norm(stimulus.H_sweep[0]):
+            vinit = cmtj.CVector(*(stimulus.H_sweep[0] /
+                                   np.linalg.norm(stimulus.H_sweep[0])))
+        else:
+            # we have a 0 vector, align with Kdir
+            vinit = cmtj.CVector(*org_layers[i].Kdir)
+        m_init.append(vinit)
+    return m_init
+
+
+class JunctionLog:
+    """
+    Reads the magnetisation of every layer from the cmtj log into a
+    (layers, 3, steps) buffer reused from one run to the next.
+    The buffer is sized for the longest run so far, shorter runs are
+    read into its first steps. Only the m keys are converted, the time
+    is converted only when the buffer grows, since every run restarts
+    from 0 with the same step.
+    """
+
+    def __init__(self, org_layer_strs: List[str]):
+        self.keys = [[f"{layer}_m{axis}" for axis in "xyz"]
+                     for layer in org_layer_strs]
+        self.m_buffer = np.empty((len(self.keys), 3, 0))
+        self.time_buffer = np.empty(0)
+        self.m = None
+        self.time = None
+
+    def read(self, junction: cmtj.Junction) -> np.ndarray:
+        """
+        Fill the buffer from the junction log.
+        The buffer is overwritten by the next read, copy to keep it.
+        """
+        log = junction.getLog()
+        steps = len(log['time'])
+        if steps > self.m_buffer.shape[-1]:
+            self.m_buffer = np.empty((len(self.keys), 3, steps))
+            self.time_buffer = np.asarray(log['time'])
+        self.m = self.m_buffer[..., :steps]
+        self.time = self.time_buffer[:steps]
+        for i, layer_keys in enumerate(self.keys):
+            for j, key in enumerate(layer_keys):
+                self.m[i, j] = log[key]
+        return self.m
+
+
+def PIMM_chain(simulation_input: SimulationInput,
+               handle_signals: Callable[[], int], H_indices: List[int],
+               m_init: List[cmtj.CVector]):
+    """
+    Relaxation after a short Oersted pulse for every H point.
+    Yields the static quantities, the trajectory and the PIMM spectrum.
+    The trajectory is a buffer overwritten at the next H point, and so
+    is the spectrum in the peak-only mode (DataConfig.PIMM_PEAKS),
+    otherwise it's a new row, taken as it is by the partial result.
+    m_init is carried in place from one H point to the next.
+    With DataConfig.PIMM_STREAM_SEGMENT_STEPS, the relaxation is run in
+    consecutive runs of that many steps, see relaxation_segments, and
+    the spectrum is accumulated over them (Bartlett's method: the square
+    root of the mean power spectrum of the segments, weighted by the
+    steps they ran). A shorter last run is taken as flat up to the
+    segment length, both in its spectrum and as the trajectory. Only the
+    last run is kept as the trajectory.
+    With DataConfig.RELAXATION_DMDT_TOLERANCE, the relaxation is run in
+    chunks and stops early once it has relaxed. The rest of the
+    relaxation is then taken as flat, so the spectrum keeps the same
+    frequencies.
+    """
+    stimulus: StimulusObject = simulation_input.stimulus
+    int_step = stimulus.LLG_time / stimulus.LLG_steps
+    org_layers: List[Layer] = simulation_input.layers
+    no_org_layers = len(org_layers)
+    org_layer_strs = [str(layer.layer) for layer in org_layers]
+    R_params = resistance_parameters(org_layers)
+    Ms = np.asarray([layer.Ms for layer in org_layers])[:, np.newaxis]
+    junction = build_junction(org_layers)
+    junction_log = JunctionLog(org_layer_strs)
+    # the same frequencies as PIMM_frequencies, whatever cmtj logs
+    pimm_spectrum = PIMMSpectrum(relaxation_steps(stimulus), int_step)
+    segment_steps = relaxation_segments(stimulus)
+    segments = len(segment_steps)
+    # reused, the peaks are taken before the next H point is run
+    peaks_spectrum = np.empty(len(pimm_spectrum.freqs), dtype=np.float32)
+    segment_spectrum = np.empty_like(peaks_spectrum)
+    early_exit = DataConfig.RELAXATION_DMDT_TOLERANCE is not None
+    min_steps = int(DataConfig.RELAXATION_MIN_TIME_FRACTION *
+                    stimulus.LLG_steps)
+    m_relaxation = None
+    if segments == 1 and early_exit:
+        # chunks of a single relaxation, gathered in one buffer
+        chunks = max(1, DataConfig.RELAXATION_CHUNKS)
+        chunk_steps = [
+            stimulus.LLG_steps // chunks + (i < stimulus.LLG_steps % chunks)
+            for i in range(chunks)
+        ]
+        m_relaxation = np.empty((no_org_layers, 3, stimulus.LLG_steps))
+    else:
+        chunk_steps = segment_steps
+    for H_indx in H_indices:
+        if not handle_signals():
+            return
+        set_external_field(junction, stimulus.H_sweep[H_indx])
+        junction.clearLog()
+        for i in range(no_org_layers):
+            junction.setLayerMagnetisation(org_layer_strs[i], m_init[i])
+        configure_PIMM_excitation(junction, int_step)
+
+        yf = peaks_spectrum if DataConfig.PIMM_PEAKS else np.empty_like(
+            peaks_spectrum)
+        done_steps = 0
+        for chunk, steps in enumerate(chunk_steps):
+            if chunk:
+                if not handle_signals():
+                    return
+                junction.clearLog()
+                switch_off_PIMM_excitation(junction)
+            junction.runSimulation(steps * int_step, int_step, int_step)
+            m_chunk = junction_log.read(junction)
+            if m_relaxation is not None:
+                m_relaxation[..., done_steps:done_steps +
+                             m_chunk.shape[-1]] = m_chunk
+            else:
+                mixed = np.mean(m_chunk[:, 2] * Ms, axis=0)
+                spectrum = pimm_spectrum(
+                    mixed, out=segment_spectrum if segments > 1 else yf)
+                if segments > 1:
+                    # a short last segment counts for the steps it ran
+                    weight = min(1., m_chunk.shape[-1] / pimm_spectrum.steps)
+                    if not chunk:
+                        power = weight * spectrum.astype(float)**2
+                        weights = weight
+                    else:
+                        power += weight * spectrum.astype(float)**2
+                        weights += weight
+            done_steps += m_chunk.shape[-1]
+            if early_exit and done_steps >= min_steps and relaxed(
+                    m_chunk, int_step):
+                break
+        if m_relaxation is not None:
+            m_relaxation[..., done_steps:] = m_relaxation[..., done_steps -
+                                                          1:done_steps]
+            m_traj = m_relaxation
+            mixed = np.mean(m_traj[:, 2] * Ms, axis=0)
+            pimm_spectrum(mixed, out=yf)
+        else:
+            m_traj = m_chunk
+            if m_chunk.shape[-1] < pimm_spectrum.steps:
+                # as wide as the trajectory store or the shared rows
+                m_traj = np.pad(
+                    m_chunk,
+                    ((0, 0), (0, 0),
+                     (0, pimm_spectrum.steps - m_chunk.shape[-1])),
+                    mode="edge")
+            if segments > 1:
+                yf[:] = np.sqrt(power / weights)
+        for i in range(no_org_layers):
+            m_init[i] = junction.getLayerMagnetisation(org_layer_strs[i])
+        # take last m step
+        m = m_chunk[:, :, -1]  # all layers, all x, y, z, last timestamp
+        m_avg = np.mean(m, axis=0)  # average over layers
+        Rx, Ry, Rz = calculate_resistance(m=m, **R_params)
+
+        # compute the L2 convergence over last 100 iterations
+        # just take the first layer
+        k = min(101, m_chunk.shape[-1])
+        l1 = m_chunk[0, :, -k:]
+        dmdt = np.linalg.norm((l1 - np.roll(l1, shift=1))[1:]).mean()
+        yield m_avg, Rx, Ry, Rz, m_traj, dmdt, yf, pimm_spectrum.freqs
+
+
+def VSD_chain(simulation_input: SimulationInput,
+              handle_signals: Callable[[], int], H_indices: List[int],
+              m_init: List[cmtj.CVector]):
+    """
+    SD-FMR frequency loop for every H point.
+    Yields the Rxx and Rxy spin diode data, None if there are
+    no SD frequencies. A frequency starts from the final state of the
+    closest frequency already run for the same H point, the first one
+    from m_init. m_init is carried in place from one H point to the
+    next, as the state of the highest frequency.
+    With DataConfig.VSD_CYCLE_LIMITED, a frequency whose checks and
+    demodulation fit in LLG_time is only run until steady state, and
+    demodulated over a whole number of periods.
+    With DataConfig.VSD_MULTITONE and at least
+    DataConfig.VSD_MULTITONE_MIN_TONES frequencies, all of them are
+    driven at once in a single run per H point, and each one is
+    demodulated from the same trajectory.
+    With DataConfig.VSD_ADAPTIVE_FREQUENCIES, only that many frequencies
+    are run per H point, see adaptive_frequency_indices, and the others
+    are interpolated.
+    """
+    stimulus: StimulusObject = simulation_input.stimulus
+    s_time = stimulus.LLG_time
+    int_step = s_time / stimulus.LLG_steps
+    org_layers: List[Layer] = simulation_input.layers
+    no_org_layers = len(org_layers)
+    org_layer_strs = [str(layer.layer) for layer in org_layers]
+    R_params = resistance_parameters(org_layers)
+    junction = build_junction(org_layers)
+    junction_log = JunctionLog(org_layer_strs)
+    for H_indx in H_indices:
+        if not len(stimulus.SD_freqs):
+            yield None, None
+            continue
+        Rx_vsd = VoltageSpinDiodeData.empty(1, len(stimulus.SD_freqs))
+        Ry_vsd = VoltageSpinDiodeData.empty(1, len(stimulus.SD_freqs))
+        set_external_field(junction, stimulus.H_sweep[H_indx])
+        if DataConfig.VSD_MULTITONE and len(
+                stimulus.SD_freqs) >= DataConfig.VSD_MULTITONE_MIN_TONES:
+            if not handle_signals():
+                return
+            junction.clearLog()
+            for i in range(no_org_layers):
+                junction.setLayerMagnetisation(org_layer_strs[i], m_init[i])
+            phases = multitone_phases(len(stimulus.SD_freqs))
+            configure_VSD_excitation(frequency=stimulus.SD_freqs,
+                                     org_layers_strs=org_layer_strs,
+                                     org_layers=org_layers,
+                                     junction=junction,
+                                     stimulus=stimulus,
+                                     phase=phases)
+            junction.runSimulation(s_time, int_step, int_step)
+            for i in range(no_org_layers):
+                m_init[i] = junction.getLayerMagnetisation(org_layer_strs[i])
+            m = junction_log.read(junction)
+            dynamicRx, dynamicRy, _ = calculate_resistance(m=m, **R_params)
+            dynamicR = np.stack((dynamicRx, dynamicRy))
+            for f_indx, (frequency, phase) in enumerate(
+                    zip(stimulus.SD_freqs, phases)):
+                # the rectified response of a tone is its current
+                # mixed with the resistance oscillating at all the tones
+                dynamicI = stimulus.I_dc + stimulus.I_rf * \
+                    np.sin(2 * np.pi * frequency * junction_log.time + phase)
+                Rxx_vsd_data, Rxy_vsd_data = compute_vsd_channels(
+                    dynamicR=dynamicR,
+                    frequency=frequency,
+                    integration_step=int_step,
+                    dynamicI=dynamicI,
+                    excitation_phase=phase)
+                Rx_vsd.write(0, f_indx, Rxx_vsd_data)
+                Ry_vsd.write(0, f_indx, Rxy_vsd_data)
+            yield Rx_vsd, Ry_vsd
+            continue
+        # final state of every frequency run so far
+        m_final: Dict[int, List[cmtj.CVector]] = {}
+        for f_indx in adaptive_frequency_indices(Rx_vsd,
+                                                 len(stimulus.SD_freqs)):
+            frequency = stimulus.SD_freqs[f_indx]
+            if not handle_signals():
+                return
+            junction.clearLog()
+            if m_final:
+                # from the closest frequency run, the lower one on a tie
+                m_start = m_final[min(m_final,
+                                      key=lambda f: (abs(f - f_indx), f))]
+            else:
+                m_start = m_init
+            for i in range(no_org_layers):
+                junction.setLayerMagnetisation(org_layer_strs[i], m_start[i])
+
+            excite = partial(configure_VSD_excitation,
+                             frequency=frequency,
+                             org_layers_strs=org_layer_strs,
+                             org_layers=org_layers,
+                             junction=junction,
+                             stimulus=stimulus)
+            cycle_limited = DataConfig.VSD_CYCLE_LIMITED and (
+                DataConfig.VSD_CHECK_PERIODS +
+                DataConfig.VSD_DEMODULATION_PERIODS) / frequency < s_time
+            if cycle_limited:
+                m, time, phase = run_to_steady_state(junction,
+                                                     junction_log,
+                                                     excite=excite,
+                                                     frequency=frequency,
+                                                     int_step=int_step,
+                                                     max_time=s_time)
+            else:
+                excite()
+                junction.runSimulation(s_time, int_step, int_step)
+                m = junction_log.read(junction)
+                time = junction_log.time
+                phase = 0.
+            m_final[f_indx] = [
+                junction.getLayerMagnetisation(layer_str)
+                for layer_str in org_layer_strs
+            ]
+
+            dynamicRx, dynamicRy, _ = calculate_resistance(m=m, **R_params)
+            dynamicI = stimulus.I_dc + stimulus.I_rf * \
+                np.sin(2 * np.pi * frequency * time)
+            Rxx_vsd_data, Rxy_vsd_data = compute_vsd_channels(
+                dynamicR=np.stack((dynamicRx, dynamicRy)),
+                frequency=frequency,
+                integration_step=int_step,
+                dynamicI=dynamicI,
+                reference_steps=stimulus.LLG_steps if cycle_limited else None,
+                excitation_phase=phase)
+            Rx_vsd.write(0, f_indx, Rxx_vsd_data)
+            Ry_vsd.write(0, f_indx, Rxy_vsd_data)
+        if m_final:
+            # the next H point starts from the highest frequency
+            m_init[:] = m_final[max(m_final)]
+        Rx_vsd.interpolate_row(0, stimulus.SD_freqs)
+        Ry_vsd.interpolate_row(0, stimulus.SD_freqs)
+        yield Rx_vsd, Ry_vsd
+
+
+def adaptive_frequency_indices(vsd: VoltageSpinDiodeData,
+                               frequency_steps: int) -> Iterable[int]:
+    """
+    Order of the SD frequencies run for a single H point. All of them,
+    unless DataConfig.VSD_ADAPTIVE_FREQUENCIES is set, then a coarse
+    grid of half of that number is followed by the midpoints of the
+    neighbours whose DC or first harmonic differ the most.
+    :param vsd
+        row 0 is read for the results of the yielded frequencies,
+        it has to be written before the next one is drawn
+    """
+    budget = DataConfig.VSD_ADAPTIVE_FREQUENCIES
+    if not budget or budget >= frequency_steps:
+        yield from range(frequency_steps)
+        return
+    simulated = sorted(
+        set(
+            np.linspace(0, frequency_steps - 1,
+                        max(2, budget // 2)).round().astype(int).tolist()))
+    yield from simulated
+    while len(simulated) < budget:
+        values = np.stack((vsd.DC[0, simulated], vsd.FHarmonic[0, simulated]))
+        value_range = np.ptp(values, axis=1, keepdims=True)
+        value_range[value_range == 0] = 1
+        change = np.max(np.abs(np.diff(values, axis=1)) / value_range, axis=0)
+        # only the intervals with a frequency left in between
+        change[np.diff(simulated) < 2] = -1
+        i = np.argmax(change)
+        if change[i] < 0:
+            return
+        f_indx = (simulated[i] + simulated[i + 1]) // 2
+        yield f_indx
+        simulated.insert(i + 1, f_indx)
+
+
+def is_periodic(m: np.ndarray, time: np.ndarray, period: float) -> bool:
+    """
+    Whether the last period of m repeats the one before it,
+    within DataConfig.VSD_STEADY_STATE_TOLERANCE
+    :param m
+        (layers, 3, steps) trajectory
+    """
+    if time[-1] - 2 * period < time[0]:
+        return False
+    m = m.reshape(-1, m.shape[-1])
+    last = time >= time[-1] - period
+    previous = np.stack([
+        np.interp(time[last] - period, time, component) for component in m
+    ])
+    return np.max(np.abs(m[:, last] -
+                         previous)) <= DataConfig.VSD_STEADY_STATE_TOLERANCE
+
+
+def run_to_steady_state(junction: cmtj.Junction, junction_log: JunctionLog,
+                        excite: Callable[[float], None], frequency: float,
+                        int_step: float, max_time: float):
+    """
+    Drive the junction in runs of DataConfig.VSD_CHECK_PERIODS periods
+    until the response is periodic, then run at least
+    DataConfig.VSD_DEMODULATION_PERIODS more periods to demodulate.
+    Every run restarts from t = 0, the phase of the excitation carries
+    the elapsed time over.
+    :param excite
+        sets the excitation, given its phase keyword
+    :param max_time
+        no more checks once this time would be exceeded
+    :return (layers, 3, steps) m and the time of the demodulated periods,
+        and the phase of the excitation at their start. The harmonic
+        phases are relative to it, it's removed to compare them with
+        those of a run from t = 0
+    """
+    period = 1. / frequency
+    check_steps = max(2, round(DataConfig.VSD_CHECK_PERIODS * period / int_step))
+    # a whole number of periods, as close as it gets to a whole number
+    # of steps, between once and twice the periods asked for: the
+    # remainder leaks the first harmonic into the second
+    periods = min(range(DataConfig.VSD_DEMODULATION_PERIODS,
+                        2 * DataConfig.VSD_DEMODULATION_PERIODS + 1),
+                  key=lambda k: abs(k * period / int_step -
+                                    round(k * period / int_step)))
+    demodulation_steps = max(2, round(periods * period / int_step))
+    elapsed = 0.
+    while True:
+        excite(phase=(2 * np.pi * frequency * elapsed) % (2 * np.pi))
+        junction.clearLog()
+        junction.runSimulation(check_steps * int_step, int_step, int_step)
+        elapsed += check_steps * int_step
+        m = junction_log.read(junction)
+        if is_periodic(m, junction_log.time, period) or elapsed + (
+                check_steps + demodulation_steps) * int_step > max_time:
+            break
+    phase = (2 * np.pi * frequency * elapsed) % (2 * np.pi)
+    excite(phase=phase)
+    junction.clearLog()
+    junction.runSimulation(demodulation_steps * int_step, int_step, int_step)
+    return junction_log.read(junction), junction_log.time + elapsed, phase
+
+
+def _VSD_chain_worker(config: dict, simulation_input: SimulationInput,
+                      H_indices: List[int], m_init: List[List[float]],
+                      VSD_queue):
+    DataConfig.restore(config)
+    m_init = [cmtj.CVector(*m) for m in m_init]
+    for Rx_vsd, Ry_vsd in VSD_chain(simulation_input, lambda: 1, H_indices,
+                                    m_init):
+        VSD_queue.put(
+            (Rx_vsd, Ry_vsd, [vector_to_list(m) for m in m_init]))
+
+
+class ConcurrentVSDChain:
+    """
+    VSD_chain run in a separate process, with its own junction.
+    The process is started right away with the current DataConfig
+    settings, the results are read back in the H order.
+    """
+
+    def __init__(self, simulation_input: SimulationInput,
+                 H_indices: List[int], m_init: List[cmtj.CVector]) -> None:
+        self.m_init = m_init
+        self.remaining = len(H_indices)
+        ctx = mp.get_context("spawn")
+        self.VSD_queue = ctx.Queue()
+        self.process = ctx.Process(target=_VSD_chain_worker,
+                                   args=(DataConfig.snapshot(),
+                                         simulation_input, H_indices,
+                                         [vector_to_list(m) for m in m_init],
+                                         self.VSD_queue),
+                                   daemon=True)
+        self.process.start()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if not self.remaining:
+            raise StopIteration
+        while True:
+            try:
+                Rx_vsd, Ry_vsd, m_VSD = self.VSD_queue.get(timeout=0.1)
+                break
+            except queue.Empty:
+                if not self.process.is_alive():
+                    raise RuntimeError("VSD chain process has died")
+        self.remaining -= 1
+        self.m_init[:] = [cmtj.CVector(*m) for m in m_VSD]
+        return Rx_vsd, Ry_vsd
+
+    def close(self):
+        # stops the VSD chain early if the sweep was interrupted
+        self.process.terminate()
+        self.process.join()
+
+
+def create_trajectory_store(
+        simulation_input: SimulationInput) -> TrajectoryStore:
+    """
+    File backed store for the kept trajectories of the whole sweep,
+    if DataConfig.TRAJECTORY_STORE_DIR is set. There's room for the
+    points the adaptive sweep may add, after the uniform sweep.
+    Has to be created by the process that reads the results.
+    """
+    if DataConfig.TRAJECTORY_STORE_DIR is None:
+        return None
+    stimulus: StimulusObject = simulation_input.stimulus
+    trajectory_policy = TrajectoryPolicy.from_config()
+    layers = len(simulation_input.layers)
+    H_stride = trajectory_policy.effective_H_stride(
+        H_points=sweep_points(stimulus),
+        layers=layers,
+        steps=relaxation_steps(stimulus))
+    if not H_stride:
+        return None
+    return TrajectoryStore.create(
+        DataConfig.TRAJECTORY_STORE_DIR,
+        H_points=sweep_points(stimulus),
+        H_stride=H_stride,
+        shape=(layers, 3, trajectory_policy.kept_steps(
+            relaxation_steps(stimulus))),
+        dtype=trajectory_policy.dtype)
+
+
+def PIMM_frequencies(stimulus: StimulusObject) -> np.ndarray:
+    """
+    Frequencies of the PIMM spectra, as yielded by PIMM_chain
+    """
+    return PIMMSpectrum(relaxation_steps(stimulus),
+                        stimulus.LLG_time / stimulus.LLG_steps).freqs
+
+
+def create_shared_rows(
+        simulation_input: SimulationInput,
+        trajectory_store: TrajectoryStore = None) -> SharedResultRows:
+    """
+    Shared memory rows for the results of the whole sweep, written by
+    a worker process, if DataConfig.SHARED_MEMORY_RESULTS is set.
+    The trajectories are kept there too, unless they go to
+    trajectory_store. The adaptive sweep doesn't know its points up
+    front and is sent through the queue.
+    Has to be created by the process that reads the results.
+    """
+    if not DataConfig.SHARED_MEMORY_RESULTS or DataConfig.H_ADAPTIVE_POINTS:
+        return None
+    stimulus: StimulusObject = simulation_input.stimulus
+    H_points = len(stimulus.H_sweep)
+    steps = relaxation_steps(stimulus)
+    PIMM_length = 0 if DataConfig.PIMM_PEAKS else len(
+        PIMM_frequencies(stimulus))
+    layout = {
+        "_m_avg": ((H_points, 3), "float64"),
+        "_PIMM": ((H_points, PIMM_length), "float32"),
+        "_PIMM_peaks": ((H_points, DataConfig.PIMM_PEAKS, 3), "float64"),
+        "_Rx": ((H_points, ), "float64"),
+        "_Ry": ((H_points, ), "float64"),
+        "_Rz": ((H_points, ), "float64"),
+        "_L2convergence_dm": ((H_points, ), "float64"),
+    }
+    if len(stimulus.SD_freqs):
+        for name in ("Rxx_vsd", "Rxy_vsd"):
+            for field in fields(VoltageSpinDiodeData):
+                layout[f"{name}.{field.name}"] = ((H_points,
+                                                   len(stimulus.SD_freqs)),
+                                                  "float64")
+    H_stride = 1
+    if trajectory_store is None:
+        trajectory_policy = TrajectoryPolicy.from_config()
+        layers = len(simulation_input.layers)
+        H_stride = trajectory_policy.effective_H_stride(H_points=H_points,
+                                                        layers=layers,
+                                                        steps=steps)
+        if H_stride:
+            layout["m_traj"] = ((-(-H_points // H_stride), layers, 3,
+                                 trajectory_policy.kept_steps(steps)),
+                                trajectory_policy.dtype)
+    rows = SharedResultRows.create(layout, H_stride=max(1, H_stride))
+    for name, array in rows.arrays.items():
+        if "_vsd." in name:
+            # unwritten cells are NaN, as in VoltageSpinDiodeData.empty
+            array.fill(np.nan)
+    return rows
+
+
+def simulate(simulation_input: SimulationInput,
+             handle_signals: Callable[[], int],
+             H_indices: Iterable[int] = None,
+             state: SweepState = None,
+             trajectory_store: TrajectoryStore = None,
+             warm_start: Callable[[int], SweepState] = None):
+    """
+    Run the H sweep of a single simulation, yielding a partial
+    ResultHolder per H point.
+    The PIMM and the VSD chains carry separate magnetisation states
+    and separate junctions, so with DataConfig.CONCURRENT_PIMM_VSD
+    the VSD chain runs in its own process alongside the PIMM chain.
+    :param simulation_input
+        layers and stimulus of the simulation
+    :param handle_signals
+        called before every expensive step, the sweep stops
+        if it returns 0
+    :param H_indices
+        indices of stimulus.H_sweep to run, the whole sweep by default
+    :param state
+        warm start of the magnetisation. It is updated in place
+        after every H point, so it holds the final state once
+        the generator is exhausted.
+    :param trajectory_store
+        the kept trajectories are written there instead of
+        being carried by the partial results
+    :param warm_start
+        called with every H index before it's run, both chains restart
+        from the state it returns, unless it's None. H_indices are then
+        drawn one at a time, after the preceding partial result was
+        taken, so they may extend the stimulus as the sweep goes on.
+        The VSD chain runs in this process.
+    """
+    stimulus: StimulusObject = simulation_input.stimulus
+    if H_indices is None:
+        H_indices = range(len(stimulus.H_sweep))
+    # initialise the magnetisation vectors
+    if state is None or state.m_PIMM is None:
+        m_init_PIMM = initial_magnetisation(simulation_input.layers,
+                                            stimulus)
+        m_init_VSD = list(m_init_PIMM)
+    else:
+        m_init_PIMM = [cmtj.CVector(*m) for m in state.m_PIMM]
+        m_init_VSD = [cmtj.CVector(*m) for m in state.m_VSD]
+
+    if warm_start is None:
+        H_indices = list(H_indices)
+        PIMM_indices = VSD_indices = H_indices
+    else:
+
+        def restarted(H_indices):
+            for H_indx in H_indices:
+                seed = warm_start(H_indx)
+                if seed is not None:
+                    m_init_PIMM[:] = [cmtj.CVector(*m) for m in seed.m_PIMM]
+                    m_init_VSD[:] = [cmtj.CVector(*m) for m in seed.m_VSD]
+                yield H_indx
+
+        # the zip below draws every index before the chains do
+        H_indices, PIMM_indices, VSD_indices = itertools.tee(
+            restarted(H_indices), 3)
+
+    trajectory_policy = TrajectoryPolicy.from_config()
+    # fixed for the whole sweep, whichever part of it is run here
+    H_stride = trajectory_policy.effective_H_stride(
+        H_points=sweep_points(stimulus),
+        layers=len(simulation_input.layers),
+        steps=relaxation_steps(stimulus))
+    if trajectory_store is not None:
+        H_stride = trajectory_store.H_stride
+    PIMM_results = PIMM_chain(simulation_input, handle_signals,
+                              PIMM_indices, m_init_PIMM)
+    if (DataConfig.CONCURRENT_PIMM_VSD and len(stimulus.SD_freqs)
+            and warm_start is None):
+        VSD_results = ConcurrentVSDChain(simulation_input, VSD_indices,
+                                         m_init_VSD)
+    else:
+        VSD_results = VSD_chain(simulation_input, handle_signals,
+                                VSD_indices, m_init_VSD)
+    try:
+        for H_indx, PIMM_result, VSD_result in zip(H_indices, PIMM_results,
+                                                   VSD_results):
+            m_avg, Rx, Ry, Rz, m_traj, dmdt, yf, pimm_freqs = PIMM_result
+            Rx_vsd, Ry_vsd = VSD_result
+            if not handle_signals():
+                return
+            if not H_stride or H_indx % H_stride:
+                m_traj = None
+            elif trajectory_store is not None:
+                trajectory_store.write(H_indx,
+                                       trajectory_policy.select(m_traj))
+                m_traj = None
+            else:
+                # the chain reuses its log buffer
+                m_traj = trajectory_policy.apply(m_traj)
+            if DataConfig.PIMM_PEAKS:
+                peaks = PIMM_peaks(yf, pimm_freqs, DataConfig.PIMM_PEAKS)
+                yf = []
+            else:
+                peaks = None
+            partial_result = ResultHolder(
+                mode=stimulus.mode,
+                H_mag=stimulus.sweep,
+                PIMM_freqs=pimm_freqs,
+                SD_freqs=stimulus.SD_freqs,
+                Rx=Rx,
+                Ry=Ry,
+                Rz=Rz,
+                m_avg=m_avg,
+                m_traj=m_traj,
+                L2convergence_dm=dmdt,
+                PIMM=yf,
+                PIMM_peaks=peaks,
+                Rxx_vsd=Rx_vsd,
+                Rxy_vsd=Ry_vsd,
+                trajectory_store=trajectory_store)
+            if state is not None:
+                state.m_PIMM = [vector_to_list(m) for m in m_init_PIMM]
+                state.m_VSD = [vector_to_list(m) for m in m_init_VSD]
+            yield partial_result
+    finally:
+        VSD_results.close()
+
+
+def coarse_relaxation(simulation_input: SimulationInput,
+                      seed_indices: List[int],
+                      handle_signals: Callable[[], int]) -> List[SweepState]:
+    """
+    Cheap serial pass over the sweep -- only the relaxation is run,
+    with a coarser integration step and no logging. The step still
+    resolves the precession about the field of every H point.
+    Without SD frequencies, the VSD chain never runs and its state stays
+    at the initial magnetisation, so that's what it's seeded with.
+    :param seed_indices
+        H indices after which the relaxed state is recorded
+    :return the recorded states, in the order of seed_indices
+    """
+    stimulus: StimulusObject = simulation_input.stimulus
+    s_time = stimulus.LLG_time
+    fine_step = s_time / stimulus.LLG_steps
+    int_step = DataConfig.SEGMENT_COARSE_FACTOR * fine_step
+    org_layers: List[Layer] = simulation_input.layers
+    org_layer_strs = [str(layer.layer) for layer in org_layers]
+    junction = build_junction(org_layers)
+    m_init = initial_magnetisation(org_layers, stimulus)
+    for i, m in enumerate(m_init):
+        junction.setLayerMagnetisation(org_layer_strs[i], m)
+    # same excitation as the PIMM step of the full sweep
+    configure_PIMM_excitation(junction, int_step)
+
+    seeds = {}
+    for H_indx in range(max(seed_indices) + 1):
+        if not handle_signals():
+            return []
+        set_external_field(junction, stimulus.H_sweep[H_indx])
+        junction.clearLog()
+        # a tenth of the precession period about the field at most,
+        # a coarser step diverges at high fields
+        step = int_step
+        H = np.linalg.norm(stimulus.H_sweep[H_indx])
+        if H:
+            step = min(step, max(fine_step, 0.1 * 2 * np.pi /
+                                 (mu0_x_gamma * H)))
+        junction.runSimulation(s_time, step, s_time)
+        if H_indx in seed_indices:
+            m = [
+                vector_to_list(junction.getLayerMagnetisation(layer_str))
+                for layer_str in org_layer_strs
+            ]
+            m_VSD = m
+            if not len(stimulus.SD_freqs):
+                m_VSD = [vector_to_list(vector) for vector in m_init]
+            seeds[H_indx] = SweepState(m_PIMM=m, m_VSD=m_VSD)
+    return [seeds[indx] for indx in seed_indices]
+
+
+def states_agree(state: SweepState, other: SweepState) -> bool:
+    """
+    Both chains are within DataConfig.SEGMENT_BOUNDARY_TOLERANCE
+    """
+    return all(
+        np.max(
+            np.linalg.norm(np.asarray(getattr(state, chain.name)) -
+                           np.asarray(getattr(other, chain.name)),
+                           axis=-1)) <= DataConfig.SEGMENT_BOUNDARY_TOLERANCE
+        for chain in fields(SweepState))
+
+
+def _segment_worker(simulation_input: SimulationInput, H_indices: range,
+                    state: SweepState, trajectory_store: TrajectoryStore,
+                    stop: SharedFlag):
+    """
+    :param stop
+        set once the seeded segments of this simulation aren't needed,
+        the segment returns at the next H point
+    """
+
+    def handle_signals():
+        if stop.is_set():
+            return 0
+        return _worker_signals()
+
+    results, states = [], []
+    for partial_result in simulate(simulation_input,
+                                   handle_signals,
+                                   H_indices=H_indices,
+                                   state=state,
+                                   trajectory_store=trajectory_store):
+        results.append(partial_result)
+        states.append(SweepState(m_PIMM=state.m_PIMM, m_VSD=state.m_VSD))
+    return results, states
+
+
+def simulate_segmented(simulation_input: SimulationInput,
+                       handle_signals: Callable[[], int],
+                       executor: ProcessPoolExecutor,
+                       segments: int,
+                       trajectory_store: TrajectoryStore = None):
+    """
+    Split the H sweep into contiguous segments and run them on the
+    executor. Every segment but the first is warm started from the
+    coarse relaxation pass, which seeds both chains. Once the preceding
+    segment is done, its final state is compared with that seed. If
+    either chain disagrees, the segment is re-run serially from the
+    exact state, until it agrees with the state the seeded run had at
+    the same H point -- the seeded results are taken from there on.
+    After the first disagreement, the seeds aren't trusted anymore: the
+    later segments are cancelled, or stopped if they're running, and the
+    rest of the sweep is run serially once they've returned.
+    Partial results are yielded in the sweep order.
+    """
+    stimulus: StimulusObject = simulation_input.stimulus
+    H_ranges = split_sweep(stimulus.H_sweep, segments)
+    if len(H_ranges) == 1:
+        yield from simulate(simulation_input,
+                            handle_signals,
+                            trajectory_store=trajectory_store)
+        return
+    seeds = coarse_relaxation(simulation_input,
+                              [H_range.start - 1 for H_range in H_ranges[1:]],
+                              handle_signals)
+    if not seeds:
+        return
+    state = SweepState(m_PIMM=None, m_VSD=None)
+    first_segment = simulate(simulation_input,
+                             handle_signals,
+                             H_indices=H_ranges[0],
+                             state=state,
+                             trajectory_store=trajectory_store)
+    # the segments of this simulation only, the executor may be shared
+    stop = SharedFlag.create()
+    futures = [
+        executor.submit(_segment_worker, simulation_input, H_range, seed,
+                        trajectory_store, stop)
+        for H_range, seed in zip(H_ranges[1:], seeds)
+    ]
+    try:
+        yield from first_segment
+        for segment, (H_range, seed, future) in enumerate(
+                zip(H_ranges[1:], seeds, futures)):
+            while not future.done():
+                if not handle_signals():
+                    return
+                time.sleep(0.1)
+            if state.m_PIMM is None:
+                # killed before the preceding segment finished
+                return
+            results, states = future.result()
+            if states_agree(state, seed):
+                state = states[-1]
+                yield from results
+                continue
+            # e.g. a weakly damped stack, still precessing at the end
+            # of every relaxation, disagrees at the other boundaries too
+            stop.set()
+            for later in futures[segment + 1:]:
+                later.cancel()
+            # nothing else writes the trajectory rows once they've returned
+            while not all(later.done() for later in futures[segment + 1:]):
+                if not handle_signals():
+                    return
+                time.sleep(0.1)
+            serial_segment = simulate(simulation_input,
+                                      handle_signals,
+                                      H_indices=H_range,
+                                      state=state,
+                                      trajectory_store=trajectory_store)
+            for i, partial_result in enumerate(serial_segment):
+                yield partial_result
+                if states_agree(state, states[i]):
+                    serial_segment.close()
+                    state = states[-1]
+                    # the trajectories of the remaining points are
+                    # those of the seeded run
+                    yield from results[i + 1:]
+                    break
+            if state.m_PIMM is None or H_range.stop == len(stimulus.H_sweep):
+                return
+            yield from simulate(simulation_input,
+                                handle_signals,
+                                H_indices=range(H_range.stop,
+                                                len(stimulus.H_sweep)),
+                                state=state,
+                                trajectory_store=trajectory_store)
+            return
+    finally:
+        stop.set()
+        for future in futures:
+            future.cancel()
+
+
+def sweep_features(result: ResultHolder) -> np.ndarray:
+    """
+    Quantities of a partial result followed by the adaptive sweep:
+    m_avg, Rx, Ry, Rz and the PIMM peak frequency
+    """
+    if result.PIMM_peaks.shape[1]:
+        peak_frequency = np.nan_to_num(result.PIMM_peaks[0, 0, 0])
+    else:
+        peak_frequency = np.ravel(
+            result.PIMM_freqs)[np.argmax(result.PIMM[0])]
+    return np.array([
+        *result.m_avg[0], result.Rx[0], result.Ry[0], result.Rz[0],
+        peak_frequency
+    ])
+
+
+def interpolate_field(stimulus: StimulusObject, left: int, right: int):
+    """
+    Field vector and sweep value half way between two sweep points.
+    Angle sweeps keep the field magnitude.
+    """
+    H_left = np.asarray(stimulus.H_sweep[left])
+    H_right = np.asarray(stimulus.H_sweep[right])
+    H = (H_left + H_right) / 2
+    if stimulus.mode != SweepMode.H:
+        norm = (np.linalg.norm(H_left) + np.linalg.norm(H_right)) / 2
+        if np.linalg.norm(H):
+            H = norm * H / np.linalg.norm(H)
+    return H.tolist(), (stimulus.sweep[left] + stimulus.sweep[right]) / 2
+
+
+def simulate_adaptive(simulation_input: SimulationInput,
+                      handle_signals: Callable[[], int],
+                      trajectory_store: TrajectoryStore = None):
+    """
+    Run the H sweep, then insert points where m_avg, the resistances or
+    the PIMM peak change the most between neighbours, until
+    DataConfig.H_ADAPTIVE_POINTS are added or every change is below
+    DataConfig.H_ADAPTIVE_TOLERANCE of its range.
+    The uniform sweep is yielded as it's run. The inserted points
+    continue on the same chains, restarted from the state of their
+    preceding neighbour, the points after it are not re-run. They are
+    yielded one by one, with H_position set to their place in the
+    sweep order, see ResultHolder.merge_result.
+    The H indices of the inserted points, also in trajectory_store,
+    follow the uniform sweep.
+    """
+    # extended with the inserted points
+    stimulus: StimulusObject = simulation_input.stimulus.model_copy(
+        deep=True)
+    uniform_points = len(stimulus.H_sweep)
+    # indices of the stimulus, in the sweep order
+    branches = [list(H_range) for H_range in split_sweep(stimulus.H_sweep, 1)]
+    state = SweepState(m_PIMM=None, m_VSD=None)
+    states, features = [], []
+    restarts: Dict[int, SweepState] = {}
+
+    def width(indices, i):
+        return abs(stimulus.sweep[indices[i + 1]] - stimulus.sweep[indices[i]])
+
+    min_width = min((width(indices, i)
+                     for indices in branches
+                     for i in range(len(indices) - 1)),
+                    default=0) / 2**DataConfig.H_ADAPTIVE_MAX_DEPTH
+
+    def H_indices():
+        # drawn once the preceding point's features are in
+        yield from range(uniform_points)
+        feature_range = np.ptp(features, axis=0)
+        feature_range[feature_range == 0] = 1
+        for _ in range(DataConfig.H_ADAPTIVE_POINTS):
+            change, branch, position = max(
+                ((np.max(
+                    np.abs(features[indices[i + 1]] - features[indices[i]]) /
+                    feature_range), branch, i)
+                 for branch, indices in enumerate(branches)
+                 for i in range(len(indices) - 1)
+                 if width(indices, i) > min_width),
+                default=(0, None, None))
+            if change < DataConfig.H_ADAPTIVE_TOLERANCE:
+                return
+            left = branches[branch][position]
+            H, sweep = interpolate_field(stimulus, left,
+                                         branches[branch][position + 1])
+            stimulus.H_sweep.append(H)
+            stimulus.sweep.append(sweep)
+            H_indx = len(stimulus.H_sweep) - 1
+            branches[branch].insert(position + 1, H_indx)
+            restarts[H_indx] = states[left]
+            yield H_indx
+
+    for H_indx, partial_result in enumerate(
+            simulate(SimulationInput(layers=simulation_input.layers,
+                                     stimulus=stimulus),
+                     handle_signals,
+                     H_indices=H_indices(),
+                     state=state,
+                     trajectory_store=trajectory_store,
+                     warm_start=restarts.get)):
+        states.append(SweepState(m_PIMM=state.m_PIMM, m_VSD=state.m_VSD))
+        features.append(sweep_features(partial_result))
+        if H_indx >= uniform_points:
+            order = [indx for indices in branches for indx in indices]
+            partial_result.H_mag = [stimulus.sweep[H_indx]]
+            partial_result.H_position = order.index(H_indx)
+        yield partial_result
+
+
+"""
+Process pool workers -- state is set once per worker by the initializer
+"""
+_worker_queue = None
+_worker_kill_event = None
+
+
+def create_executor(workers: int,
+                    result_queue=None,
+                    kill_event=None) -> ProcessPoolExecutor:
+    """
+    Spawn based process pool with the worker state initialised,
+    including the current DataConfig settings.
+    The events have to come from the spawn context.
+    """
+    ctx = mp.get_context("spawn")
+    return ProcessPoolExecutor(max_workers=workers,
+                               mp_context=ctx,
+                               initializer=_init_worker,
+                               initargs=(DataConfig.snapshot(), result_queue,
+                                         kill_event or ctx.Event()))
+
+
+def _init_worker(config: dict, result_queue, kill_event):
+    global _worker_queue, _worker_kill_event
+    DataConfig.restore(config)
+    _worker_queue = result_queue
+    _worker_kill_event = kill_event
+
+
+def _worker_signals():
+    if _worker_kill_event.is_set():
+        return 0
+    return 1
+
+
+def _simulation_worker(sim_index: int,
+                       simulation_input: SimulationInput,
+                       trajectory_store: TrajectoryStore = None,
+                       shared_rows: SharedResultRows = None):
+    """
+    Simulate in a worker process and stream the partial results
+    back in batches, following the SimulationStatus protocol.
+    With shared_rows, the rows are written there instead and only
+    (sim_index, range of H indices, IN_PROGRESS) is put in the queue
+    for every batch.
+    """
+    if shared_rows is not None:
+        _shared_rows_worker(sim_index, simulation_input, trajectory_store,
+                            shared_rows)
+        return
+    batch_update = []
+    if DataConfig.H_ADAPTIVE_POINTS:
+        partial_results = simulate_adaptive(simulation_input,
+                                            _worker_signals,
+                                            trajectory_store=trajectory_store)
+    else:
+        partial_results = simulate(simulation_input,
+                                   _worker_signals,
+                                   trajectory_store=trajectory_store)
+    for partial_result in partial_results:
+        batch_update.append(
+            (sim_index, partial_result, SimulationStatus.IN_PROGRESS))
+        if (len(batch_update) % DataConfig.BATCH_UPDATE_COUNT) == 0:
+            _worker_queue.put(batch_update)
+            batch_update = []
+    if _worker_kill_event.is_set():
+        return
+    if len(batch_update):
+        _worker_queue.put(batch_update)
+    _worker_queue.put((sim_index, ..., SimulationStatus.DONE))
+
+
+def _shared_rows_worker(sim_index: int, simulation_input: SimulationInput,
+                        trajectory_store: TrajectoryStore,
+                        shared_rows: SharedResultRows):
+    if trajectory_store is None:
+        trajectory_store = shared_rows.trajectory_store
+    start = 0
+    try:
+        for H_indx, partial_result in enumerate(
+                simulate(simulation_input,
+                         _worker_signals,
+                         trajectory_store=trajectory_store)):
+            shared_rows.write(H_indx, partial_result)
+            if (H_indx + 1 - start) % DataConfig.BATCH_UPDATE_COUNT == 0:
+                _worker_queue.put((sim_index, range(start, H_indx + 1),
+                                   SimulationStatus.IN_PROGRESS))
+                start = H_indx + 1
+        if _worker_kill_event.is_set():
+            return
+        stop = len(simulation_input.stimulus.H_sweep)
+        if stop > start:
+            _worker_queue.put((sim_index, range(start, stop),
+                               SimulationStatus.IN_PROGRESS))
+        _worker_queue.put((sim_index, ..., SimulationStatus.DONE))
+    finally:
+        shared_rows.close()
+
+
+def run(simulation_input: SimulationInput,
+        handle_signals: Callable[[], int] = None) -> ResultHolder:
+    """
+    Simulate without the GUI.
+    :param simulation_input
+        layers and stimulus of the simulation
+    :param handle_signals
+        optional, see simulate
+    :return the result of the whole sweep, None if the sweep
+        was stopped before the first H point
+    """
+    if handle_signals is None:
+        handle_signals = lambda: 1
+    executor = None
+    kill_event = None
+    trajectory_store = create_trajectory_store(simulation_input)
+    if DataConfig.H_ADAPTIVE_POINTS:
+        partial_results = simulate_adaptive(simulation_input,
+                                            handle_signals,
+                                            trajectory_store=trajectory_store)
+    elif DataConfig.H_SWEEP_SEGMENTS > 1:
+        kill_event = mp.get_context("spawn").Event()
+        executor = create_executor(DataConfig.H_SWEEP_SEGMENTS - 1,
+                                   kill_event=kill_event)
+        partial_results = simulate_segmented(
+            simulation_input,
+            handle_signals,
+            executor=executor,
+            segments=DataConfig.H_SWEEP_SEGMENTS,
+            trajectory_store=trajectory_store)
+    else:
+        partial_results = simulate(simulation_input,
+                                   handle_signals,
+                                   trajectory_store=trajectory_store)
+    result = None
+    try:
+        for partial_result in partial_results:
+            if result is None:
+                result = partial_result
+            else:
+                result.merge_result(partial_result)
+    finally:
+        if executor is not None:
+            # running segments stop at the event
+            kill_event.set()
+            executor.shutdown(wait=True, cancel_futures=True)
+    return result
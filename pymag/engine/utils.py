@@ -1,12 +1,28 @@
+from functools import lru_cache
+from typing import List
+
 import numpy as np
 from numpy.linalg import norm
-from scipy.signal import butter, lfilter
+from scipy.signal import butter, sosfilt
 
 gamma = 1.76e11  # 1/(Ts)
 mu0 = 1.255e-6  # N/A^2
 mu0_x_gamma = gamma * mu0
 Am_to_Oe = 79.57
 
+unicode_subs = {
+    "theta": "\u03B8",
+    "phi": "\u03C6",
+    "lam": "\u03BB",
+    "beta": "\u03B2",
+    "eng": "\u014B",
+    "zeta_fl": "\u03B6 FL",
+    "zeta_dl": "\u03B6 DL",
+    "h_fl": "H FL",
+    "h_dl": "H DL"
+}
+inverse_subs = {v: k for k, v in unicode_subs.items()}
+
 
 class SimulationStatus:
     KILLED = "KILLED"
@@ -67,29 +83,108 @@ def get_stimulus(H, Hmin, Hmax, theta, ThetaMin, ThetaMax, phi, PhiMin, PhiMax,
     return np.vstack((Hx, Hy, Hz)).T, Hmag
 
 
-def butter_bandpass_filter(data, pass_freq, fs, order=5):
+def parse_vector(vector_str_value) -> List[int]:
+    if vector_str_value == "x":
+        return [1, 0, 0]
+    elif vector_str_value == "y":
+        return [0, 1, 0]
+    elif vector_str_value == "z":
+        return [0, 0, 1]
+    else:
+        raise ValueError(f'Invalid vector value: {vector_str_value}')
+
+
+def split_sweep(H_sweep, segments):
+    """
+    Split the sweep indices into contiguous ranges.
+    The forward and back branches of the sweep are never mixed
+    in a single range.
+    :param H_sweep
+        (N, 3) field vectors
+    :param segments
+        requested number of ranges
+    """
+    H_sweep = np.asarray(H_sweep)
+    half = len(H_sweep) // 2
+    if len(H_sweep) > 1 and len(H_sweep) % 2 == 0 and np.allclose(
+            H_sweep[half:], -H_sweep[:half]):
+        branches = [range(0, half), range(half, len(H_sweep))]
+    else:
+        branches = [range(0, len(H_sweep))]
+    segments = max(segments, len(branches))
+    H_ranges = []
+    for branch in branches:
+        branch_segments = min(
+            len(branch),
+            max(1, round(segments * len(branch) / len(H_sweep))))
+        for indices in np.array_split(np.asarray(branch), branch_segments):
+            H_ranges.append(range(indices[0], indices[-1] + 1))
+    return H_ranges
+
+
+@lru_cache(maxsize=128)
+def butter_sos(order, critical_frequency, btype):
+    """
+    Cached Butterworth design in second-order sections.
+    :param critical_frequency
+        normalised to the Nyquist frequency, a (low, high) tuple for bandpass
+    """
+    return butter(order,
+                  critical_frequency,
+                  btype=btype,
+                  analog=False,
+                  output='sos')
+
+
+def butter_bandpass_filter(data, pass_freq, fs, order=5, axis=-1):
+    """
+    :param data
+        time series, or stacked channels filtered along axis
+    """
     nyq = 0.5 * fs
     if pass_freq == 0:
         pass_freq = 0.1
     try:
-        b, a = butter(order, [0.9 * pass_freq / nyq, pass_freq / nyq],
-                      btype='bandpass',
-                      analog=False)
+        sos = butter_sos(order, (0.9 * pass_freq / nyq, pass_freq / nyq),
+                         'bandpass')
     except ValueError:
         print(fs, pass_freq, nyq, 0.9 * pass_freq / nyq, pass_freq / nyq)
         raise ValueError("Error in filtering")
-    y = lfilter(b, a, data, zi=None)
+    y = sosfilt(sos, data, axis=axis)
     return y
 
 
-def butter_lowpass_filter(data, cutoff, fs, order=5):
+def butter_lowpass_filter(data, cutoff, fs, order=5, axis=-1):
+    """
+    :param data
+        time series, or stacked channels filtered along axis
+    """
     nyq = 0.5 * fs
     normal_cutoff = cutoff / nyq
-    b, a = butter(order, normal_cutoff, btype='low', analog=False)
-    y = lfilter(b, a, data, zi=None)
+    sos = butter_sos(order, normal_cutoff, 'low')
+    y = sosfilt(sos, data, axis=axis)
     return y
 
 
+def harmonic_bins(frequency,
+                  N,
+                  integration_step,
+                  harmonics=(1, 2),
+                  neighbourhood=5) -> np.ndarray:
+    """
+    Indices of the one-sided fft bins closest to every harmonic
+    of frequency, for a series of length N.
+    :returns
+        (len(harmonics), neighbourhood) bin indices, within [0, N // 2],
+        repeated at the edge if there are fewer bins than neighbourhood
+    """
+    centre = np.rint(
+        np.asarray(harmonics) * frequency * N * integration_step).astype(int)
+    start = np.clip(centre - neighbourhood // 2, 0,
+                    max(0, N // 2 - neighbourhood))
+    return np.clip(start[:, np.newaxis] + np.arange(neighbourhood), 0, N // 2)
+
+
 def cos_between_arrays(vec1, vec2):
     return np.dot(np.array(vec1), np.array(vec2)) / (norm(
         np.array(vec1) * norm(np.array(vec2))))
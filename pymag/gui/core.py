@@ -8,12 +8,12 @@ import pyqtgraph as pg
 from PyQt6 import QtCore, QtWidgets
 
 from pymag.engine.utils import *
+from pymag.engine.utils import inverse_subs, unicode_subs
 from pymag.gui.exporter import Exporter
 from pymag.gui.plot_manager import PlotManager
 from pymag.gui.simulation_manager import (ExperimentManager, GeneralManager,
                                           Simulation)
 from pymag.gui.stimulus import StimulusGUI
-from pymag.gui.utils import inverse_subs, unicode_subs
 
 
 class SimulationParameters():
@@ -1,8 +1,8 @@
 import logging
-import multiprocessing as mp
 import os
 import queue
 import sys
+import time
 
 import pandas as pd
 import pyqtgraph as pg
@@ -10,6 +10,7 @@ from PyQt6.QtWidgets import QMainWindow
 from pyqtgraph.dockarea import Dock, DockArea
 
 from pymag import __version__
+from pymag.config import DataConfig
 from pymag.engine.data_holders import Layer, SimulationInput
 from pymag.engine.utils import SimulationStatus
 from pymag.gui.core import AddMenuBar, ResultsTable, SimulationParameters
@@ -68,7 +69,8 @@ class UIMainWindow(QMainWindow):
             trajectory_plot=self.traj_widget,
             trajectory_components=self.trajectory_components,
             convergence_plot=self.convergence_plot)
-        self.result_queue = mp.Queue()
+        # producer and consumer share the process, see SolverTask
+        self.result_queue = queue.Queue(maxsize=DataConfig.RESULT_QUEUE_SIZE)
         self.central_layout = AddMenuBar(parent=self, docks=self.area)
 
         self.global_experiment_manager = ExperimentManager()
@@ -141,7 +143,7 @@ class UIMainWindow(QMainWindow):
         self.ports = []
         self.timer = pg.QtCore.QTimer()
         self.timer.timeout.connect(self.on_simulation_data_update)
-        self.timer.start(10)
+        self.timer.start(DataConfig.GUI_MIN_REDRAW_INTERVAL_MS)
 
         self.central_layout.load_dock_state()
         self.show()
@@ -184,34 +186,66 @@ class UIMainWindow(QMainWindow):
         self.global_sim_manager.simulate_selected()
 
     def on_simulation_data_update(self):
-        try:
-            updates = self.result_queue.get(block=False)
+        """
+        Drain the result queue for at most DataConfig.GUI_DRAIN_BUDGET_MS,
+        then replot once. The plots show a single simulation, the last
+        one that got new rows. The timer interval follows the time the
+        replot took.
+        """
+        deadline = time.perf_counter() + DataConfig.GUI_DRAIN_BUDGET_MS / 1e3
+        updated = {}
+        while time.perf_counter() < deadline:
+            try:
+                updates = self.result_queue.get(block=False)
+            except queue.Empty:
+                logging.debug("Queue emptied!")
+                break
             if isinstance(updates, list):
                 for (sim_indx, res, status) in updates:
                     # update batch
                     self.global_sim_manager.update_simulation_data(
                         sim_indx, res)
                     self.global_sim_manager.update_status(sim_indx, status)
-                    self.simulation_manager.update_row(sim_indx)
-                self.plot_manager.plot_result(
-                    self.global_sim_manager.get_simulation(sim_indx))
+                    # last updated last
+                    updated.pop(sim_indx, None)
+                    updated[sim_indx] = True
+                continue
+            (sim_indx, _, status) = updates
+            if status == SimulationStatus.ALL_DONE:
+                self.central_layout.set_btn_start_position()
+            elif status == SimulationStatus.DONE:
+                self.global_sim_manager.mark_as_done(sim_indx)
+                self.simulation_manager.update_list()
+            elif status == SimulationStatus.KILLED:
+                # now sim_indx is a list of the sim indices that were in the
+                # compute backend
+                for indx in sim_indx:
+                    self.global_sim_manager.reset_simulation_output(indx)
+                    self.global_sim_manager.update_status(
+                        indx, SimulationStatus.KILLED)
+                    updated.pop(indx, None)
+                self.plot_manager.clear_simulation_plots()
             else:
-                (sim_indx, _, status) = updates
-                if status == SimulationStatus.ALL_DONE:
-                    self.central_layout.set_btn_start_position()
-                elif status == SimulationStatus.DONE:
-                    self.global_sim_manager.mark_as_done(sim_indx)
-                    self.simulation_manager.update_list()
-                elif status == SimulationStatus.KILLED:
-                    # now sim_indx is a list of the sim indices that were in the
-                    # compute backend
-                    for indx in sim_indx:
-                        self.global_sim_manager.reset_simulation_output(indx)
-                        self.global_sim_manager.update_status(
-                            indx, SimulationStatus.KILLED)
-                    self.plot_manager.clear_simulation_plots()
-                else:
-                    raise ValueError("Unknown simulation status received!")
-                self.simulation_manager.update_row(sim_indx)
-        except queue.Empty:
-            logging.debug("Queue emptied!")
+                raise ValueError("Unknown simulation status received!")
+            self.simulation_manager.update_row(sim_indx)
+        if not updated:
+            return
+        self.simulation_manager.update_row(list(updated))
+        start = time.perf_counter()
+        self.plot_manager.plot_result(
+            self.global_sim_manager.get_simulation(list(updated)[-1]))
+        self.adapt_redraw_interval(1e3 * (time.perf_counter() - start))
+
+    def adapt_redraw_interval(self, render_ms: float):
+        """
+        Keep the replots at most 1/DataConfig.GUI_REDRAW_LOAD of the time,
+        within the min and max redraw interval
+        """
+        interval = min(
+            max(DataConfig.GUI_REDRAW_LOAD * render_ms,
+                DataConfig.GUI_MIN_REDRAW_INTERVAL_MS),
+            DataConfig.GUI_MAX_REDRAW_INTERVAL_MS)
+        # smoothed, a single slow frame shouldn't stall the plots
+        interval = round(0.7 * self.timer.interval() + 0.3 * interval)
+        if interval != self.timer.interval():
+            self.timer.setInterval(interval)
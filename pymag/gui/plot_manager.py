@@ -124,7 +124,7 @@ class PlotManager:
             if M:
                 self.magnetisation_plot.set_experimental(i, x, M)
 
-    def plot_trajectory(self, m_trajectories: np.ndarray):
+    def plot_trajectory(self, m_trajectories: List[np.ndarray]):
         """
         Update the trajectory on the OpenGL widget
         """
@@ -132,12 +132,17 @@ class PlotManager:
             # happens at first call
             return
 
-        t = np.arange(m_trajectories.shape[-1])
-
         self.trajectory_plot.clear()
         self.trajectory_components.nuke_plots()
-        for i in range(m_trajectories.shape[1]):  # iterate over layers
-            X = m_trajectories[self.H_select, i, :, :]
+        if self.H_select >= len(m_trajectories) or \
+                m_trajectories[self.H_select] is None:
+            # not kept by the trajectory policy
+            self.trajectory_plot.w.update()
+            return
+        m_trajectory = m_trajectories[self.H_select]
+        t = np.arange(m_trajectory.shape[-1])
+        for i in range(m_trajectory.shape[0]):  # iterate over layers
+            X = m_trajectory[i, :, :]
             c = RGB_tuples[i]
             cplot = [[p * 255 for p in RGB_tuples[i][:-1]] for _ in range(3)]
             self.trajectory_plot.draw_trajectory(
@@ -158,7 +163,7 @@ class PlotManager:
         """
         if not result_holder:
             return
-        lim = result_holder.update_count
+        lim = result_holder.filled
         if lim == 1:
             return
         # save for update ROI
@@ -192,9 +197,13 @@ class PlotManager:
                                         self.units[str(result_holder.mode)])
 
         if lim >= 2:
-            self.PIMM_plot.update(result_holder.H_mag[:lim],
-                                  result_holder.PIMM_freqs, result_holder.PIMM,
-                                  self.PIMM_deltaf)
+            if result_holder.PIMM_peaks.shape[1]:
+                self.PIMM_plot.update_peaks(result_holder.H_mag[:lim],
+                                            result_holder.PIMM_peaks)
+            else:
+                self.PIMM_plot.update(result_holder.H_mag[:lim],
+                                      result_holder.PIMM_freqs,
+                                      result_holder.PIMM, self.PIMM_deltaf)
 
             self.PIMM_plot.update_axis(left_caption="PIMM-FMR Frequency",
                                        left_units="Hz",
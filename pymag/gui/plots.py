@@ -65,6 +65,45 @@ class MultiplePlot(QWidget):
             self.plots[i].removeItem(self.experimental_plots[i])
 
 
+def uniform_row_index(xrange) -> tuple:
+    """
+    Image rows have to be equally spaced. The sweep is split into its
+    monotonic branches (e.g. forward and back) and the rows of each
+    branch are resampled to the nearest one on a uniform grid, with the
+    smallest step of the sweep.
+    :returns
+        index of the sweep row of every image row, None if the sweep
+        is already uniform, and the sweep values of the image rows
+    """
+    xrange = np.asarray(xrange, dtype=float)
+    step = np.diff(xrange)
+    if len(step) < 2 or np.allclose(step, step[0]) or not np.any(step):
+        return None, xrange
+    sign = np.sign(step)
+    # (start, stop) of the branches: a branch ends at a repeated value,
+    # or at the point the sweep turns at, which also starts the next one
+    branches = [[0, len(xrange)]]
+    for i in range(len(step)):
+        if sign[i] == 0:
+            branches[-1][1] = i + 1
+            branches.append([i + 1, len(xrange)])
+        elif i and sign[i - 1] != 0 and sign[i] != sign[i - 1]:
+            branches[-1][1] = i + 1
+            branches.append([i, len(xrange)])
+    min_step = np.abs(step[step != 0]).min()
+    row_index, image_xrange = [], []
+    for start, stop in branches:
+        branch = xrange[start:stop]
+        points = min(
+            int(np.ceil(abs(branch[-1] - branch[0]) / min_step)) + 1,
+            8 * len(branch))
+        grid = np.linspace(branch[0], branch[-1], points)
+        row_index.append(start + np.abs(grid[:, np.newaxis] -
+                                        branch).argmin(axis=1))
+        image_xrange.append(grid)
+    return np.concatenate(row_index), np.concatenate(image_xrange)
+
+
 class SpectrogramPlot():
 
     def __init__(self, spectrum_enabled=False):
@@ -115,6 +154,12 @@ class SpectrogramPlot():
         self.plot_image.addItem(self.inf_line)
         self.plot_image.addItem(self.inf_line_H)
 
+        # peak-only PIMM results
+        self.peak_overlay = pg.ScatterPlotItem(pen=pg.mkPen('w', width=1),
+                                               brush=pg.mkBrush(255, 0, 0),
+                                               size=6)
+        self.plot_image.addItem(self.peak_overlay)
+
         self.experimental_overlay = pg.PlotCurveItem()
         self.image.addItem(self.experimental_overlay)
 
@@ -125,6 +170,9 @@ class SpectrogramPlot():
         self.cross_section.showGrid(x=True, y=True, alpha=0.6)
         self.xrange = None
         self.yrange = None
+        # H of the image rows, uniform even if xrange isn't
+        self.image_xrange = None
+        self.row_index = None
 
         # only for VSD
         self.Rxx_holder: VoltageSpinDiodeData = None
@@ -149,10 +197,10 @@ class SpectrogramPlot():
 
             for n, ac in zip([
                     "DC", "1st harmonic", "2nd harmonic", "1st harmonic phase",
-                    "2nd harmonic phase"
+                    "2nd harmonic phase", "Simulated cells"
             ], [
                     "DC", "FHarmonic", "SHarmonic", "FHarmonic_phase",
-                    "SHarmonic_phase"
+                    "SHarmonic_phase", "simulated"
             ]):
 
                 a = harmonic_group.addAction(
@@ -195,7 +243,10 @@ class SpectrogramPlot():
         def menu_action():
             holder = getattr(self, self.resistance_mode + "_holder")
             if holder:
-                vals = self.detrend_f_axis(getattr(holder, property))
+                vals = getattr(holder, property)
+                if property != "simulated":
+                    vals = self.detrend_f_axis(vals)
+                vals = self.uniform_rows(vals)
                 self.image_spectrum.setImage(vals, autoLevels=False)
                 # mean, std = self.compute_histogram_fadeout(vals)
                 # self.image.getHistogramWidget().setLevels(
@@ -212,19 +263,44 @@ class SpectrogramPlot():
         self.plot_image.setLabel('bottom', bottom_caption, units=bottom_units)
 
     def update_roi(self):
-        if not (self.xrange is None):
-            cross_section = int(self.inf_line.value() / self.deltaf)
+        if not (self.xrange is None
+                or self.image_spectrum.image is None):
+            # the frequency axis doesn't have to start at 0
+            cross_section = int(
+                (self.inf_line.value() - min(self.yrange)) / self.deltaf)
             if cross_section >= self.image_spectrum.image.shape[
                     1] or cross_section < 0:
                 return
             self.cross_section.clear()
             self.cross_section.plot(
-                self.xrange,
-                self.image_spectrum.image[:,
-                                          int(self.inf_line.value() /
-                                              self.deltaf)],
+                self.image_xrange,
+                self.image_spectrum.image[:, cross_section],
                 pen=pg.mkPen('b', width=5))
 
+    def set_xrange(self, xrange):
+        """
+        The rows of a non-uniform sweep (adaptive sweep) are resampled
+        per branch, see uniform_row_index
+        """
+        self.xrange = xrange
+        self.row_index, self.image_xrange = uniform_row_index(xrange)
+
+    def uniform_rows(self, values):
+        if self.row_index is None:
+            return values
+        return np.asarray(values)[self.row_index]
+
+    def set_image_transform(self, yrange):
+        # the image is replaced, the peaks of an earlier result go too
+        self.peak_overlay.clear()
+        self.image_spectrum.resetTransform()
+        tr = QtGui.QTransform()
+        tr.translate(min(self.image_xrange), min(yrange))
+        tr.scale((max(self.image_xrange) - min(self.image_xrange)) /
+                 len(self.image_xrange),
+                 (max(yrange) - min(yrange)) / len(yrange))
+        self.image_spectrum.setTransform(tr)
+
     def get_current_field_cross_section(self):
         return self.inf_line_H.value()
 
@@ -232,17 +308,13 @@ class SpectrogramPlot():
         """
         PIMM update
         """
-        self.xrange = xrange
+        self.set_xrange(xrange)
         self.yrange = yrange
         self.deltaf = deltaf
 
-        self.image_spectrum.resetTransform()
-        tr = QtGui.QTransform()
-        tr.translate(min(xrange), min(yrange))
-        tr.scale((max(xrange) - min(xrange)) / len(xrange),
-                 (max(yrange) - min(yrange)) / len(yrange))
-        self.image_spectrum.setTransform(tr)
-        self.image_spectrum.setImage(values, autoLevels=False)
+        self.set_image_transform(yrange)
+        self.image_spectrum.setImage(self.uniform_rows(values),
+                                     autoLevels=False)
         # _, std = self.compute_histogram_fadeout(values)
         # self.image.getHistogramWidget().setLevels(
         #     0, 0.6*std)  # is not symmetric -- due to FFT
@@ -263,18 +335,26 @@ class SpectrogramPlot():
         """
         Voltage spin diode update
         """
-        self.xrange = xrange
+        self.set_xrange(xrange)
         self.yrange = yrange
         self.deltaf = deltaf
-        self.image_spectrum.resetTransform()
-        tr = QtGui.QTransform()
-        tr.translate(min(xrange), min(yrange))
-        tr.scale((max(xrange) - min(xrange)) / len(xrange),
-                 (max(yrange) - min(yrange)) / len(yrange))
-        self.image_spectrum.setTransform(tr)
+        self.set_image_transform(yrange)
         self.action_menu_generator(self.current_action)()
         self.image.updateImage()
 
+    def update_peaks(self, xrange, peaks):
+        """
+        Peak-only PIMM update
+        :param peaks
+            (H, peaks, 3) frequency, amplitude and FWHM
+        """
+        x = np.repeat(np.asarray(xrange), peaks.shape[1])
+        y = peaks[..., 0].ravel()
+        found = ~np.isnan(y)
+        # the peaks replace the spectrum image
+        self.image_spectrum.clear()
+        self.peak_overlay.setData(x[found], y[found])
+
     def update_plot(self, x, y):
         self.plot_image.scatterPlot(x,
                                     y,
@@ -282,12 +362,10 @@ class SpectrogramPlot():
                                     alpha=0.6)
 
     def detrend_f_axis(self, values):
-        values2 = np.empty(values.shape)
-        for f in range(0, values.shape[1]):
-            values2[:, f] = values[:, f] - np.median(values[:, f])
-        return values2
+        return values - np.median(values, axis=0, keepdims=True)
 
     def clear_plots(self):
         self.image_spectrum.clear()
+        self.peak_overlay.clear()
         self.cross_section.clear()
         return
@@ -1,4 +1,4 @@
-from multiprocessing import Queue
+from queue import Queue
 from typing import List, Set, Union
 
 from PyQt6 import QtCore
@@ -36,6 +36,9 @@ class Simulation(GenericHolder):
         # TODO check if simulation's finished
         if self.simulation_result is None:
             self.simulation_result = partial_result
+        elif self.simulation_result is partial_result:
+            # rows shared with a worker process, already in place
+            return
         else:
             self.simulation_result.merge_result(partial_result)
 
@@ -2,12 +2,11 @@ import json
 import os
 from typing import List
 
-import numpy as np
 from pydantic.types import Json
 from PyQt6 import QtCore, QtWidgets
 
 from pymag.engine.data_holders import StimulusObject
-from pymag.engine.utils import SweepMode, get_stimulus
+from pymag.engine.utils import SweepMode, parse_vector
 
 from .utils import Labelled
 
@@ -68,14 +67,7 @@ class StimulusGUI():
         json.dump(self.to_json(), open(self.preset_file, "w"), indent=4)
 
     def parse_vector(self, vector_str_value) -> List[int]:
-        if vector_str_value == "x":
-            return [1, 0, 0]
-        elif vector_str_value == "y":
-            return [0, 1, 0]
-        elif vector_str_value == "z":
-            return [0, 0, 1]
-        else:
-            raise ValueError('Invalid vector value: {vector_str_value}')
+        return parse_vector(vector_str_value)
 
     def get_stimulus_object(self) -> StimulusObject:
         """
@@ -83,59 +75,17 @@ class StimulusGUI():
         object.
         Calculates the values necessary for calculation while parsing as well.
         """
-        mode = self.HMode.Value.currentText()
-        if mode == SweepMode.H:
-            steps = int(self.HSteps.Value.value())
-            back = (
-                self.HBack.Value.checkState() == QtCore.Qt.CheckState.Checked)
-        if mode == SweepMode.PHI:
-            steps = int(self.HPhiSteps.Value.value())
-            back = (self.HPhiBack.Value.checkState() ==
-                    QtCore.Qt.CheckState.Checked)
-        if mode == SweepMode.THETA:
-            steps = int(self.HThetaSteps.Value.value())
-            back = (self.HThetaBack.Value.checkState() ==
-                    QtCore.Qt.CheckState.Checked)
-        # convert H from kA/m -> A/m
-        H_sweep, sweep = get_stimulus(self.H.Value.value() * 1e3,
-                                      self.HMin.Value.value() * 1e3,
-                                      self.HMax.Value.value() * 1e3,
-                                      self.HTheta.Value.value(),
-                                      self.HThetaMin.Value.value(),
-                                      self.HThetaMax.Value.value(),
-                                      self.HPhi.Value.value(),
-                                      self.HPhiMin.Value.value(),
-                                      self.HPhiMax.Value.value(), steps, back,
-                                      mode)
-        f_min = self.fmin.Value.value() * 1e9
-        f_max = self.fmax.Value.value() * 1e9
-        f_steps = int(self.fsteps.Value.value())
-        LLG_steps = int(self.LLGsteps.Value.value())
-        LLG_time = self.LLGtime.Value.value() / 1e9  # ns -> s
-        PIMM_delta_f = 1. / LLG_time
-        PIMM_freqs = np.arange(0, PIMM_delta_f * LLG_steps, step=PIMM_delta_f)
-        SD_freqs = np.linspace(f_min, f_max, f_steps)
-        spectrum_len = LLG_steps // 2
-        so = StimulusObject(
-            mode=mode,
-            H_sweep=H_sweep.tolist(),
-            sweep=sweep.tolist(),
-            LLG_steps=LLG_steps,
-            LLG_time=LLG_time,
-            frequency_min=f_min,
-            frequency_max=f_max,
-            frequency_steps=f_steps,
-            I_rf=self.Iac.Value.value(),
-            I_dc=self.Idc.Value.value(),
-            I_dir=self.parse_vector(self.Idir.Value.currentText()),
-            V_dir=self.parse_vector(self.Vdir.Value.currentText()),
-            # PIMM and VSD
-            spectrum_len=spectrum_len,
-            SD_freqs=SD_freqs.tolist(),
-            PIMM_freqs=PIMM_freqs.tolist(),
-            PIMM_delta_f=PIMM_delta_f,
-            stimulus_json=self.to_json())
-        return so
+        values = {}
+        obj: Labelled
+        for obj in self.stimulus_objects:
+            if obj.mode == "Combo":
+                values[obj.var_name] = obj.Value.currentText()
+            elif obj.mode == "Binary":
+                values[obj.var_name] = (
+                    obj.Value.checkState() == QtCore.Qt.CheckState.Checked)
+            else:
+                values[obj.var_name] = obj.Value.value()
+        return StimulusObject.from_values(values, stimulus_json=self.to_json())
 
     def H_mode_changed(self):
         mode = self.HMode.Value.currentText()
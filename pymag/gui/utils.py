@@ -3,19 +3,6 @@ from typing import Any, Dict
 from PyQt6.QtWidgets import (QCheckBox, QComboBox, QDoubleSpinBox, QLabel,
                              QSpinBox)
 
-unicode_subs = {
-    "theta": "\u03B8",
-    "phi": "\u03C6",
-    "lam": "\u03BB",
-    "beta": "\u03B2",
-    "eng": "\u014B",
-    "zeta_fl": "\u03B6 FL",
-    "zeta_dl": "\u03B6 DL",
-    "h_fl": "H FL",
-    "h_dl": "H DL"
-}
-inverse_subs = {v: k for k, v in unicode_subs.items()}
-
 
 class Labelled():
 
@@ -0,0 +1,80 @@
+import json
+import os
+
+import numpy as np
+import pytest
+
+from pymag.engine.data_holders import (Layer, ResultHolder, SimulationInput,
+                                       StimulusObject, TrajectoryStore,
+                                       VoltageSpinDiodeData)
+
+PRESET_DIR = os.path.join(os.path.dirname(__file__), '..', 'presets')
+
+
+@pytest.fixture
+def stimulus_json():
+    """
+    Factory of the preset stimulus json, with the values replaced
+    """
+
+    def create(**values) -> dict:
+        with open(os.path.join(PRESET_DIR, "stimulus.json"), "r") as f:
+            stimulus = json.load(f)
+        for obj in stimulus["stimulus"]:
+            if obj["name"] in values:
+                obj["params"]["value"] = values[obj["name"]]
+        return stimulus
+
+    return create
+
+
+@pytest.fixture
+def simulation_input(stimulus_json):
+    """
+    Factory of the preset layers and stimulus,
+    with the stimulus values replaced
+    """
+
+    def create(**values) -> SimulationInput:
+        return SimulationInput(
+            layers=Layer.from_csv(
+                os.path.join(PRESET_DIR, "defaultParameters.csv")),
+            stimulus=StimulusObject.from_json(stimulus_json(**values)))
+
+    return create
+
+
+@pytest.fixture
+def result_row():
+    """
+    Factory of the partial result of H point H_indx,
+    with every value set to H_indx
+    """
+
+    def create(H_indx: int,
+               H_mag: list,
+               trajectory_store: TrajectoryStore = None) -> ResultHolder:
+        vsd = VoltageSpinDiodeData.empty(1, 2)
+        vsd.DC[:] = H_indx
+        m_traj = np.full((1, 3, 4), H_indx, dtype=np.float32)
+        if trajectory_store is not None:
+            # as in simulate, only the points of the H stride are written
+            if H_indx % trajectory_store.H_stride == 0:
+                trajectory_store.write(H_indx, m_traj)
+            m_traj = None
+        return ResultHolder(mode="H",
+                            H_mag=H_mag,
+                            m_avg=[H_indx] * 3,
+                            m_traj=m_traj,
+                            PIMM=[H_indx] * 5,
+                            PIMM_freqs=np.arange(5),
+                            SD_freqs=[1, 2],
+                            Rx=H_indx,
+                            Ry=H_indx,
+                            Rz=H_indx,
+                            L2convergence_dm=H_indx,
+                            Rxx_vsd=vsd,
+                            Rxy_vsd=vsd,
+                            trajectory_store=trajectory_store)
+
+    return create
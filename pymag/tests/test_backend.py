@@ -0,0 +1,235 @@
+import queue
+import threading
+import time
+
+import numpy as np
+
+from pymag.config import DataConfig
+from pymag.engine import backend
+from pymag.engine.backend import ResultChannel, SolverTask
+from pymag.engine.data_holders import SimulationInput
+from pymag.engine.solver import PIMM_frequencies
+from pymag.engine.utils import SimulationStatus
+
+
+class Simulation:
+
+    def __init__(self, simulation_input: SimulationInput):
+        self.simulation_input = simulation_input
+
+    def get_simulation_input(self) -> SimulationInput:
+        return self.simulation_input
+
+
+def run_task(simulations, workers):
+    results = queue.Queue()
+    SolverTask(results, list(range(len(simulations))),
+               simulations,
+               workers=workers).run()
+    merged, statuses = {}, []
+    while not results.empty():
+        message = results.get()
+        if not isinstance(message, list):
+            statuses.append(message[2])
+            continue
+        for sim_index, partial_result, _ in message:
+            if sim_index not in merged:
+                merged[sim_index] = partial_result
+            elif merged[sim_index] is not partial_result:
+                merged[sim_index].merge_result(partial_result)
+    return merged, statuses
+
+
+def test_pool_spectra_of_a_step_short_log(monkeypatch, simulation_input):
+    monkeypatch.setattr(DataConfig, "SHARED_MEMORY_RESULTS", True)
+    # cmtj logs 999 steps of 5 ns / 1000
+    simulations = [
+        Simulation(
+            simulation_input(HSteps=3, fmin=1., fmax=5., fsteps=2,
+                             LLGtime=5., LLGsteps=1000)) for _ in range(2)
+    ]
+    results, statuses = run_task(simulations, workers=2)
+    assert statuses.count(SimulationStatus.DONE) == 2
+    assert statuses[-1] == SimulationStatus.ALL_DONE
+    freqs = PIMM_frequencies(simulations[0].simulation_input.stimulus)
+    for result in results.values():
+        assert result.filled == 3
+        assert result.PIMM.shape == (3, len(freqs))
+        assert np.all(np.isfinite(result.PIMM))
+
+
+def test_status_message_dropped_on_a_stalled_queue(monkeypatch):
+    monkeypatch.setattr(DataConfig, "RESULT_QUEUE_STATUS_TIMEOUT", 0.3)
+    results = queue.Queue(maxsize=1)
+    results.put(None)
+    channel = ResultChannel(results, is_killed=lambda: False)
+    # nothing takes the messages off the queue, the put gives up
+    channel.put(({}, ..., SimulationStatus.ALL_DONE), force=True)
+    assert results.qsize() == 1 and channel.sent == 0
+
+
+def test_task_aborts_on_a_stopped_consumer(monkeypatch, simulation_input,
+                                           result_row):
+    monkeypatch.setattr(DataConfig, "RESULT_QUEUE_STATUS_TIMEOUT", 0.3)
+    monkeypatch.setattr(DataConfig, "BATCH_UPDATE_COUNT", 1)
+    monkeypatch.setattr(DataConfig, "BATCH_ADAPT_INTERVAL", 1e9)
+    produced = []
+
+    def simulate(*args, **kwargs):
+        for H_indx in range(20):
+            produced.append(H_indx)
+            yield result_row(H_indx, list(range(20)))
+
+    monkeypatch.setattr(backend, "simulate", simulate)
+    results = queue.Queue(maxsize=2)
+    task = SolverTask(results, [0], [Simulation(simulation_input())],
+                      workers=1)
+    messages = []
+
+    def consume():
+        # takes two batches, stops until a put times out, then the rest
+        messages.extend(results.get(timeout=5) for _ in range(2))
+        while not task.channel.stalled:
+            time.sleep(0.01)
+        while not messages or messages[-1] != ({}, ...,
+                                               SimulationStatus.ALL_DONE):
+            messages.append(results.get(timeout=5))
+
+    consumer = threading.Thread(target=consume)
+    consumer.start()
+    task.run()
+    consumer.join()
+    assert task.is_killed and task.channel.stalled
+    # the run stopped at the batch that wasn't taken
+    assert len(produced) == 5
+    rows = [
+        result.Rx[0] for message in messages if isinstance(message, list)
+        for _, result, _ in message
+    ]
+    assert rows == [0, 1, 2, 3]
+    statuses = [message for message in messages
+                if not isinstance(message, list)]
+    assert statuses == [([0], ..., SimulationStatus.KILLED),
+                        ({}, ..., SimulationStatus.ALL_DONE)]
+
+
+def test_serial_results_handed_over_without_a_copy(monkeypatch,
+                                                   simulation_input,
+                                                   result_row):
+    monkeypatch.setattr(DataConfig, "BATCH_UPDATE_COUNT", 2)
+    monkeypatch.setattr(DataConfig, "BATCH_ADAPT_INTERVAL", 1e9)
+    produced = [result_row(H_indx, list(range(5))) for H_indx in range(5)]
+    monkeypatch.setattr(backend, "simulate",
+                        lambda *args, **kwargs: iter(produced))
+    results = queue.Queue()
+    simulations = [Simulation(simulation_input())]
+    SolverTask(results, [0], simulations, workers=1).run()
+    batches = [
+        message for message in (results.get_nowait()
+                                for _ in range(results.qsize()))
+        if isinstance(message, list)
+    ]
+    assert [len(batch) for batch in batches] == [2, 2, 1]
+    # the very objects the solver yielded, in batches of their own
+    handed_over = [result for batch in batches for _, result, _ in batch]
+    assert all(result is expected
+               for result, expected in zip(handed_over, produced))
+    assert len({id(batch) for batch in batches}) == len(batches)
+
+
+def test_pool_matches_serial(simulation_input):
+    simulations = [
+        Simulation(
+            simulation_input(HSteps=4, HBack=1, fmin=2., fmax=6., fsteps=2,
+                             LLGtime=1., LLGsteps=1000)) for _ in range(2)
+    ]
+    serial, _ = run_task(simulations, workers=1)
+    pool, statuses = run_task(simulations, workers=2)
+    assert statuses.count(SimulationStatus.DONE) == 2
+    for sim_index in (0, 1):
+        expected, result = serial[sim_index], pool[sim_index]
+        assert result.filled == expected.filled == 8
+        for name in ("m_avg", "PIMM", "Rx", "Ry", "Rz"):
+            assert np.array_equal(getattr(result, name),
+                                  getattr(expected, name)), name
+        assert np.array_equal(result.Rxx_vsd.DC, expected.Rxx_vsd.DC)
+        assert np.array_equal(result.Rxy_vsd.FHarmonic,
+                              expected.Rxy_vsd.FHarmonic)
+        for m_traj, expected_m_traj in zip(result.m_traj,
+                                           expected.m_traj):
+            assert np.array_equal(m_traj, expected_m_traj)
+
+
+def test_pool_reports_a_failed_simulation(simulation_input):
+    simulations = [
+        Simulation(simulation_input(HSteps=3, fsteps=0, LLGtime=1.,
+                                    LLGsteps=1000)) for _ in range(2)
+    ]
+    # raises in the worker, when the junction is built
+    simulations[1].simulation_input.layers[0].Ms = None
+    results = queue.Queue()
+    SolverTask(results, [0, 1], simulations, workers=2).run()
+    messages = [results.get_nowait() for _ in range(results.qsize())]
+    statuses = [(message[0], message[2]) for message in messages
+                if not isinstance(message, list)]
+    assert (0, SimulationStatus.DONE) in statuses
+    assert ([1], SimulationStatus.KILLED) in statuses
+    assert statuses[-1] == ({}, SimulationStatus.ALL_DONE)
+
+
+def test_result_channel_batches(monkeypatch, result_row):
+    monkeypatch.setattr(DataConfig, "BATCH_UPDATE_COUNT", 4)
+    monkeypatch.setattr(DataConfig, "BATCH_ADAPT_INTERVAL", 1e9)
+    results = queue.Queue()
+    channel = ResultChannel(results, is_killed=lambda: False)
+    for H_indx in range(10):
+        channel.append(0, result_row(H_indx, list(range(10))))
+    channel.flush()
+    batches = [results.get_nowait() for _ in range(results.qsize())]
+    assert [len(batch) for batch in batches] == [4, 4, 2]
+    assert [result.Rx[0] for batch in batches
+            for _, result, _ in batch] == list(range(10))
+    # the consumer kept up, nothing was dropped
+    assert all(result.m_traj[0] is not None for batch in batches
+               for _, result, _ in batch)
+
+
+def test_result_channel_drops_trajectories_when_behind(monkeypatch, result_row):
+    monkeypatch.setattr(DataConfig, "BATCH_UPDATE_COUNT", 3)
+    monkeypatch.setattr(DataConfig, "BATCH_ADAPT_INTERVAL", 1e9)
+    results = queue.Queue(maxsize=4)
+    for _ in range(3):
+        results.put(None)
+    channel = ResultChannel(results, is_killed=lambda: False)
+    for H_indx in range(3):
+        channel.append(0, result_row(H_indx, list(range(3))))
+    batch = results.queue[-1]
+    assert [result.m_traj[0] is None for _, result, _ in batch
+            ] == [True, True, False]
+    # the scalars are kept
+    assert [result.Rx[0] for _, result, _ in batch] == [0, 1, 2]
+
+
+def test_result_channel_adapts_batch_size(monkeypatch, result_row):
+    monkeypatch.setattr(DataConfig, "BATCH_UPDATE_COUNT", 8)
+    monkeypatch.setattr(DataConfig, "BATCH_ADAPT_INTERVAL", 0)
+    results = queue.Queue()
+    channel = ResultChannel(results, is_killed=lambda: False)
+    # the consumer takes every batch at once, the batches shrink
+    for H_indx in range(8):
+        channel.append(0, result_row(H_indx, list(range(8))))
+    results.get_nowait()
+    assert channel.batch_size == 4
+    # the consumer falls behind, the batches grow, up to the max
+    monkeypatch.setattr(DataConfig, "MAX_BATCH_UPDATE_COUNT", 6)
+    for _ in range(3):
+        channel.send([])
+    assert channel.batch_size == 6
+
+
+def test_result_channel_drops_when_killed():
+    results = queue.Queue(maxsize=1)
+    results.put(None)
+    channel = ResultChannel(results, is_killed=lambda: True)
+    channel.put("dropped")
+    assert results.qsize() == 1 and channel.sent == 0
@@ -0,0 +1,238 @@
+import gc
+import os
+import pickle
+from multiprocessing.reduction import ForkingPickler
+
+import numpy as np
+
+from pymag.engine.data_holders import (ResultHolder, TrajectoryPolicy,
+                                       TrajectoryStore, VoltageSpinDiodeData)
+
+
+def test_vsd_grid_written_by_index():
+    vsd = VoltageSpinDiodeData.empty(3, 4)
+    assert vsd.DC.shape == vsd.SHarmonic_phase.shape == (3, 4)
+    assert np.isnan(vsd.FHarmonic).all()
+    vsd.write(
+        1, 2,
+        VoltageSpinDiodeData(DC=1.,
+                             FHarmonic=2.,
+                             SHarmonic=3.,
+                             FHarmonic_phase=4.,
+                             SHarmonic_phase=5.))
+    assert vsd.DC[1, 2] == 1 and vsd.SHarmonic_phase[1, 2] == 5
+    # only that cell
+    assert np.isnan(vsd.DC).sum() == 11
+    # the rows and the columns are views of the grid
+    row, column = vsd.row(1), vsd.column(2)
+    assert np.shares_memory(row.FHarmonic, vsd.FHarmonic)
+    assert np.shares_memory(column.FHarmonic, vsd.FHarmonic)
+    vsd.FHarmonic[1, 2] = 7.
+    assert row.FHarmonic[2] == column.FHarmonic[1] == 7.
+
+
+def test_interpolate_row_unwraps_phases():
+    frequencies = np.linspace(1e9, 5e9, 5)
+    vsd = VoltageSpinDiodeData.empty(1, len(frequencies))
+    # a phase ramp crossing pi between the simulated frequencies
+    phases = np.angle(np.exp(1j * np.linspace(2.5, 4.5, 5)))
+    for f_indx in (0, 2, 4):
+        vsd.write(
+            0, f_indx,
+            VoltageSpinDiodeData(DC=f_indx,
+                                 FHarmonic=1.,
+                                 SHarmonic=1.,
+                                 FHarmonic_phase=phases[f_indx],
+                                 SHarmonic_phase=phases[f_indx],
+                                 simulated=1.))
+    vsd.interpolate_row(0, frequencies)
+    assert np.allclose(vsd.DC[0], np.arange(5))
+    assert np.allclose(vsd.FHarmonic_phase[0], phases)
+    assert np.allclose(vsd.SHarmonic_phase[0], phases)
+    assert np.array_equal(vsd.simulated[0], [1, 0, 1, 0, 1])
+
+
+def test_merge_result_fills_reserved_rows(result_row):
+    H_mag = list(range(10))
+    result = result_row(0, H_mag)
+    for H_indx in range(1, 6):
+        result.merge_result(result_row(H_indx, H_mag))
+    assert result.filled == 6 and result.capacity >= 6
+    assert np.array_equal(result.Rx, np.arange(6))
+    assert np.array_equal(result.m_avg[:, 0], np.arange(6))
+    assert np.array_equal(result.PIMM[:, 4], np.arange(6))
+    assert np.array_equal(result.Rxx_vsd.DC[:, 1], np.arange(6))
+    assert [m_traj[0, 0, 0] for m_traj in result.m_traj] == list(range(6))
+    # the filled rows are kept when the capacity grows
+    result.reserve(20)
+    assert result.capacity == 20
+    assert np.array_equal(result.Rz, np.arange(6))
+    assert np.array_equal(result.Rxy_vsd.DC[:, 0], np.arange(6))
+    # only the filled rows are pickled
+    copy = pickle.loads(pickle.dumps(result))
+    assert copy.filled == copy.capacity == 6
+    assert copy._PIMM.shape == (6, 5)
+    assert np.array_equal(copy.Rxy_vsd.DC, result.Rxy_vsd.DC)
+    assert len(copy.m_traj) == 6
+
+
+def test_trajectory_policy_fits_the_budget():
+    policy = TrajectoryPolicy(time_subsample=2,
+                              last_steps=100,
+                              H_stride=1,
+                              dtype="float32",
+                              memory_budget_mb=1)
+    assert policy.kept_steps(1000) == 100
+    assert policy.kept_steps(101) == 51
+    m_traj = np.arange(3 * 1000, dtype=float).reshape(1, 3, 1000)
+    kept = policy.apply(m_traj)
+    assert kept.shape == (1, 3, 100) and kept.dtype == np.float32
+    assert np.array_equal(kept, m_traj[..., ::2][..., -100:])
+    # 1 MB holds 873 trajectories of 1200 bytes
+    assert policy.effective_H_stride(H_points=800, layers=1,
+                                     steps=1000) == 1
+    assert policy.effective_H_stride(H_points=2000, layers=1,
+                                     steps=1000) == 3
+    # not even a single trajectory fits
+    assert policy.effective_H_stride(H_points=10, layers=1000,
+                                     steps=1000) == 0
+    assert TrajectoryPolicy(keep=False).effective_H_stride(
+        H_points=10, layers=1, steps=10) == 0
+
+
+def test_trajectory_store_rows(tmp_path):
+    store = TrajectoryStore.create(str(tmp_path),
+                                   H_points=6,
+                                   H_stride=2,
+                                   shape=(1, 3, 4),
+                                   dtype="float32")
+    assert len(store) == 0 and store[0] is None
+    for H_indx in (0, 2, 4):
+        store.write(H_indx, np.full((1, 3, 4), H_indx))
+    assert len(store) == 5
+    assert np.all(store[2] == 2)
+    # off the stride, or not written yet
+    assert store[3] is None and store[5] is None
+    # iterated over the filled points only
+    assert [m_traj is None for m_traj in store
+            ] == [False, True, False, True, False]
+    # pickled, it's a copy of the written rows, without the file
+    copy = pickle.loads(pickle.dumps(store))
+    assert copy.filename is None and len(copy) == 5
+    assert np.all(copy[4] == 4) and copy[1] is None
+
+
+def test_trajectory_store_file_removed_with_its_store(tmp_path, result_row):
+    store = TrajectoryStore.create(str(tmp_path),
+                                   H_points=4,
+                                   H_stride=1,
+                                   shape=(1, 3, 4),
+                                   dtype="float32")
+    filename = store.filename
+    result = result_row(0, list(range(4)), trajectory_store=store)
+    # sent to a worker and back, as its partial results are
+    sent = ForkingPickler.loads(ForkingPickler.dumps(result_row(1, [], store)))
+    assert sent.trajectory_store is store and len(store) == 2
+    del store, sent
+    gc.collect()
+    # still referenced by the result
+    assert os.path.exists(filename)
+    # e.g. the simulation is reset
+    del result
+    gc.collect()
+    assert not os.path.exists(filename)
+
+
+def test_merge_result_places_inserted_points(result_row):
+    sweep = [0., 10., 20., 5., 15.]
+    result = result_row(0, sweep)
+    for H_indx in (1, 2):
+        result.merge_result(result_row(H_indx, sweep))
+    # points inserted at their place in the sweep order
+    for H_indx, H_position in ((3, 1), (4, 3)):
+        inserted = result_row(H_indx, [sweep[H_indx]])
+        inserted.H_position = H_position
+        result.merge_result(inserted)
+    assert result.H_mag == [0., 5., 10., 15., 20.]
+    assert np.array_equal(result.Rx, [0, 3, 1, 4, 2])
+    assert np.array_equal(result.Rxx_vsd.DC[:, 0], [0, 3, 1, 4, 2])
+    assert [m_traj[0, 0, 0] for m_traj in result.m_traj] == [0, 3, 1, 4, 2]
+    copy = pickle.loads(pickle.dumps(result))
+    assert copy.H_mag == result.H_mag
+    assert np.array_equal(copy.Rx, result.Rx)
+    assert [m_traj[0, 0, 0] for m_traj in copy.m_traj] == [0, 3, 1, 4, 2]
+
+
+def test_pickle_materializes_trajectory_store(tmp_path, result_row):
+    store = TrajectoryStore.create(str(tmp_path),
+                                   H_points=6,
+                                   H_stride=2,
+                                   shape=(1, 3, 4),
+                                   dtype="float32")
+    result = result_row(0, list(range(6)), store)
+    for H_indx in range(1, 5):
+        result.merge_result(result_row(H_indx, list(range(6)), store))
+    assert len(result.m_traj) == 5 and result.m_traj[1] is None
+    copy = pickle.loads(pickle.dumps(result))
+    assert copy.trajectory_store is None
+    assert not hasattr(copy, "shared_rows")
+    assert isinstance(copy.m_traj, list)
+    for H_indx in range(5):
+        if H_indx % 2:
+            assert copy.m_traj[H_indx] is None
+        else:
+            assert np.all(copy.m_traj[H_indx] == H_indx)
+
+
+class EarlierPickle:
+    """
+    Pickles as an instance of cls with the attributes of state,
+    the way an earlier version of the class was pickled
+    """
+
+    def __init__(self, cls, state: dict):
+        self.cls = cls
+        self.state = state
+
+    def __reduce__(self):
+        return object.__new__, (self.cls, ), self.state
+
+
+def test_baseline_pickle_loads(result_row):
+    vsd = EarlierPickle(
+        VoltageSpinDiodeData, {
+            name: np.arange(6.).reshape(3, 2)
+            for name in ("DC", "FHarmonic", "SHarmonic", "FHarmonic_phase",
+                         "SHarmonic_phase")
+        })
+    # a merged result of 3 H points, as it was before the
+    # preallocated columns
+    baseline = EarlierPickle(
+        ResultHolder, {
+            "mode": "H",
+            "H_mag": [0., 1., 2.],
+            "m_avg": np.arange(9.).reshape(3, 3),
+            "Rx": [0., 1., 2.],
+            "Ry": [0., 1., 2.],
+            "Rz": [0., 1., 2.],
+            "SD_freqs": [1., 2.],
+            "PIMM": np.arange(15.).reshape(3, 5),
+            "PIMM_freqs": np.arange(5),
+            "m_traj": np.zeros((3, 1, 3, 4)),
+            "update_count": 3,
+            "Rxx_vsd": vsd,
+            "Rxy_vsd": vsd,
+            "L2convergence_dm": [0., 0., 0.]
+        })
+    result = pickle.loads(pickle.dumps(baseline))
+    assert result.filled == 3
+    assert np.array_equal(result.Rx, [0, 1, 2])
+    assert np.array_equal(result.m_avg[:, 2], [2, 5, 8])
+    assert result.PIMM.shape == (3, 5) and result.PIMM_peaks.shape == (3, 0,
+                                                                        3)
+    assert len(result.m_traj) == 3 and result.m_traj[0].shape == (1, 3, 4)
+    assert np.array_equal(result.Rxx_vsd.DC[:, 1], [1, 3, 5])
+    assert np.all(result.Rxy_vsd.simulated == 1)
+    # and takes further rows
+    result.merge_result(result_row(3, [0., 1., 2., 3.]))
+    assert np.array_equal(result.Rx, [0, 1, 2, 3])
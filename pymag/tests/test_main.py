@@ -0,0 +1,38 @@
+import json
+import os
+
+import numpy as np
+import pandas as pd
+from click.testing import CliRunner
+
+from pymag.config import DataConfig
+from pymag.engine.__main__ import run_headless
+from pymag.engine.solver import run
+
+PRESET_DIR = os.path.join(os.path.dirname(__file__), '..', 'presets')
+
+
+def test_headless_run_writes_the_results(monkeypatch, tmp_path,
+                                         stimulus_json, simulation_input):
+    # the CLI sets the segments on the global config
+    monkeypatch.setattr(DataConfig, "H_SWEEP_SEGMENTS",
+                        DataConfig.H_SWEEP_SEGMENTS)
+    values = dict(HSteps=3, fmin=2., fmax=6., fsteps=2, LLGtime=1.,
+                  LLGsteps=1000)
+    stimulus = tmp_path / "stimulus.json"
+    stimulus.write_text(json.dumps(stimulus_json(**values)))
+    output = tmp_path / "out" / "sim"
+    outcome = CliRunner().invoke(run_headless, [
+        "--layers",
+        os.path.join(PRESET_DIR, "defaultParameters.csv"), "--stimulus",
+        str(stimulus), "--output",
+        str(output)
+    ])
+    assert outcome.exit_code == 0, outcome.output
+    expected = run(simulation_input(**values))
+    dynamics = pd.read_csv(f"{output}_dynamics.csv")
+    assert np.allclose(dynamics["Rx"], expected.Rx)
+    assert np.allclose(dynamics["H"], expected.H_mag)
+    pimm = pd.read_csv(f"{output}_PIMM.csv", index_col=0)
+    assert np.allclose(pimm.to_numpy(), expected.PIMM, rtol=1e-6)
+    assert os.path.exists(f"{output}SD_Rxx_DC.csv")
@@ -0,0 +1,81 @@
+import queue
+from types import SimpleNamespace
+from unittest import mock
+
+from pymag.config import DataConfig
+from pymag.engine.utils import SimulationStatus
+from pymag.gui.main_window import UIMainWindow
+
+
+class Timer:
+
+    def __init__(self, interval: int):
+        self._interval = interval
+
+    def interval(self) -> int:
+        return self._interval
+
+    def setInterval(self, interval: int):
+        self._interval = interval
+
+
+def fake_window(messages):
+    """
+    The attributes on_simulation_data_update reaches, without a display
+    """
+    result_queue = queue.Queue()
+    for message in messages:
+        result_queue.put(message)
+    return SimpleNamespace(result_queue=result_queue,
+                           global_sim_manager=mock.Mock(),
+                           simulation_manager=mock.Mock(),
+                           plot_manager=mock.Mock(),
+                           central_layout=mock.Mock(),
+                           adapt_redraw_interval=mock.Mock())
+
+
+def test_queue_drained_and_replotted_once(monkeypatch):
+    monkeypatch.setattr(DataConfig, "GUI_DRAIN_BUDGET_MS", 1e3)
+    running = SimulationStatus.IN_PROGRESS
+    window = fake_window([
+        [(0, "r0", running), (1, "r1", running)],
+        [(0, "r2", running)],
+        (0, ..., SimulationStatus.DONE),
+        ([1], ..., SimulationStatus.KILLED),
+        ({}, ..., SimulationStatus.ALL_DONE),
+    ])
+    UIMainWindow.on_simulation_data_update(window)
+    assert window.result_queue.empty()
+    assert window.global_sim_manager.update_simulation_data.call_count == 3
+    window.global_sim_manager.mark_as_done.assert_called_once_with(0)
+    window.global_sim_manager.reset_simulation_output.assert_called_once_with(
+        1)
+    window.central_layout.set_btn_start_position.assert_called_once()
+    # the killed simulation isn't replotted, the other one once
+    window.global_sim_manager.get_simulation.assert_called_once_with(0)
+    window.plot_manager.plot_result.assert_called_once()
+    window.adapt_redraw_interval.assert_called_once()
+
+
+def test_nothing_replotted_without_rows():
+    window = fake_window([({}, ..., SimulationStatus.ALL_DONE)])
+    UIMainWindow.on_simulation_data_update(window)
+    window.plot_manager.plot_result.assert_not_called()
+    window.adapt_redraw_interval.assert_not_called()
+
+
+def test_redraw_interval_follows_the_render_time(monkeypatch):
+    monkeypatch.setattr(DataConfig, "GUI_REDRAW_LOAD", 3)
+    monkeypatch.setattr(DataConfig, "GUI_MIN_REDRAW_INTERVAL_MS", 10)
+    monkeypatch.setattr(DataConfig, "GUI_MAX_REDRAW_INTERVAL_MS", 500)
+    window = SimpleNamespace(timer=Timer(100))
+    # smoothed towards 3 times the render time
+    UIMainWindow.adapt_redraw_interval(window, 100.)
+    assert window.timer.interval() == round(0.7 * 100 + 0.3 * 300)
+    # within the min and the max, up to the rounding of the smoothing
+    for _ in range(50):
+        UIMainWindow.adapt_redraw_interval(window, 1e4)
+    assert 495 <= window.timer.interval() <= 500
+    for _ in range(50):
+        UIMainWindow.adapt_redraw_interval(window, 0.)
+    assert 10 <= window.timer.interval() <= 15
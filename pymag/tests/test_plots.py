@@ -0,0 +1,27 @@
+import numpy as np
+
+from pymag.gui.plots import uniform_row_index
+
+
+def test_uniform_sweep_drawn_as_it_is():
+    row_index, image_xrange = uniform_row_index([0., 1., 2., 3.])
+    assert row_index is None
+    assert np.array_equal(image_xrange, [0, 1, 2, 3])
+
+
+def test_branches_resampled_separately():
+    # forward and back, with a point inserted on each branch
+    sweep = [0., 1., 1.5, 2., 2., 1., 0.5, 0.]
+    row_index, image_xrange = uniform_row_index(sweep)
+    assert np.allclose(image_xrange,
+                       [0, 0.5, 1, 1.5, 2, 2, 1.5, 1, 0.5, 0])
+    # the rows of a branch only come from that branch
+    assert np.all(row_index[:5] <= 3) and np.all(row_index[5:] >= 4)
+    assert np.allclose(np.asarray(sweep)[row_index], image_xrange,
+                       atol=0.5)
+    # a sweep turning without repeating its last value, the turning
+    # point is on both branches
+    row_index, image_xrange = uniform_row_index([0., 1., 1.5, 2., 1., 0.])
+    assert np.allclose(image_xrange,
+                       [0, 0.5, 1, 1.5, 2, 2, 1.5, 1, 0.5, 0])
+    assert np.array_equal(row_index[5:], [3, 3, 4, 4, 5])
@@ -0,0 +1,475 @@
+import multiprocessing as mp
+import pickle
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from pymag.config import DataConfig
+from pymag.engine import solver
+from pymag.engine.data_holders import SharedFlag, VoltageSpinDiodeData
+from pymag.engine.solver import (JunctionLog, PIMM_peaks, PIMMSpectrum,
+                                 adaptive_frequency_indices, build_junction,
+                                 compute_vsd, compute_vsd_channels,
+                                 demodulate_harmonics, multitone_phases,
+                                 relaxation_segments, run)
+
+
+def test_vsd_channels_independent_of_each_other():
+    # Rxx and Rxy in one pass give what they give one at a time,
+    # whatever the other channels
+    integration_step = 1e-12
+    frequency = 3e9
+    time = np.arange(5000) * integration_step
+    dynamicI = np.sin(2 * np.pi * frequency * time)
+    Rxx = 100 + 2 * np.sin(2 * np.pi * frequency * time + 0.3)
+    Rxy = 5 + np.cos(4 * np.pi * frequency * time)
+    fields = ("DC", "FHarmonic", "SHarmonic", "FHarmonic_phase",
+              "SHarmonic_phase")
+    single = [
+        compute_vsd(frequency, R, integration_step, dynamicI)
+        for R in (Rxx, Rxy)
+    ]
+    paired = compute_vsd_channels(frequency, np.stack((Rxx, Rxy)),
+                                  integration_step, dynamicI)
+    swapped = compute_vsd_channels(frequency, np.stack((Rxy, Rxx)),
+                                   integration_step, dynamicI)[::-1]
+    assert len(paired) == 2
+    for channels in (paired, swapped):
+        for channel, expected in zip(channels, single):
+            for field in fields:
+                assert np.isclose(getattr(channel, field),
+                                  getattr(expected, field))
+    # and differ between the channels
+    assert not np.isclose(single[0].DC, single[1].DC)
+
+
+def test_vsd_channels_tiled_per_channel():
+    # a whole number of periods, repeated up to reference_steps has to
+    # give the same DC and harmonics as the full length series
+    integration_step = 1e-12
+    frequency = 5e9
+    steps, repeats = 2000, 10
+    time = np.arange(steps * repeats) * integration_step
+    dynamicI = 1 + np.sin(2 * np.pi * frequency * time)
+    # distinct rows, Rxx oscillating and Rxy constant
+    dynamicR = np.stack(
+        (100 + np.sin(2 * np.pi * frequency * time), np.full_like(time, 5)))
+    full = compute_vsd_channels(frequency, dynamicR, integration_step,
+                                dynamicI)
+    tiled = compute_vsd_channels(frequency,
+                                 dynamicR[:, :steps],
+                                 integration_step,
+                                 dynamicI[:steps],
+                                 reference_steps=steps * repeats)
+    for full_channel, tiled_channel in zip(full, tiled):
+        assert np.isclose(tiled_channel.DC, full_channel.DC)
+        assert np.isclose(tiled_channel.FHarmonic, full_channel.FHarmonic)
+        assert np.isclose(tiled_channel.SHarmonic, full_channel.SHarmonic)
+
+
+def test_demodulate_requested_harmonics():
+    integration_step = 1e-12
+    frequency = 2e9
+    time = np.arange(10000) * integration_step
+    dynamicI = np.sin(2 * np.pi * frequency * time)
+    # the response mixes into the harmonics one order above its own
+    dynamicR = np.stack([
+        100 + np.cos(2 * np.pi * order * frequency * time)
+        for order in (1, 2, 3)
+    ])
+    DC, amplitude, phase = demodulate_harmonics(frequency,
+                                                dynamicR,
+                                                integration_step,
+                                                dynamicI,
+                                                harmonics=(1, 2, 3, 4))
+    assert DC.shape == (3, ) and amplitude.shape == phase.shape == (3, 4)
+    # 100 * I at the first harmonic, R * I / 2 at the one above R
+    assert np.allclose(amplitude[:, 0], 100 * len(time) / 2, rtol=1e-2)
+    for channel, order in enumerate((1, 2, 3)):
+        assert np.isclose(amplitude[channel, order],
+                          len(time) / 4,
+                          rtol=1e-2)
+
+
+def test_vsd_harmonics_independent_of_start_phase():
+    # the same driven response, demodulated from different points of
+    # the excitation period, as the steady state runs do
+    integration_step = 1e-12
+    frequency = 4.7e9
+    time = np.arange(20000) * integration_step
+    amplitudes, phases = [], []
+    for excitation_phase in np.linspace(0, 2 * np.pi, 9, endpoint=False):
+        phi = 2 * np.pi * frequency * time + excitation_phase
+        dynamicI = np.sin(phi)
+        dynamicR = (100 + 0.3 * np.sin(phi + 0.4))[np.newaxis]
+        vsd, = compute_vsd_channels(frequency,
+                                    dynamicR,
+                                    integration_step,
+                                    dynamicI,
+                                    excitation_phase=excitation_phase)
+        amplitudes.append((vsd.FHarmonic, vsd.SHarmonic))
+        phases.append(vsd.FHarmonic_phase)
+    assert np.allclose(amplitudes, amplitudes[0], rtol=1e-6)
+    assert np.allclose(np.exp(1j * np.array(phases)),
+                       np.exp(1j * phases[0]),
+                       atol=1e-6)
+
+
+def test_multitone_harmonics_match_single_tones():
+    integration_step = 1e-12
+    time = np.arange(10000) * integration_step
+    frequencies = np.arange(1, 6) * 1e9
+    phases = multitone_phases(len(frequencies))
+
+    def response(frequency, phase):
+        return 0.3 * np.sin(2 * np.pi * frequency * time + phase + 0.4)
+
+    dynamicR = 100 + sum(
+        response(frequency, phase)
+        for frequency, phase in zip(frequencies, phases))
+    for frequency, phase in zip(frequencies, phases):
+        single, = compute_vsd_channels(
+            frequency, (100 + response(frequency, 0))[np.newaxis],
+            integration_step, np.sin(2 * np.pi * frequency * time))
+        tone, = compute_vsd_channels(frequency,
+                                     dynamicR[np.newaxis],
+                                     integration_step,
+                                     np.sin(2 * np.pi * frequency * time +
+                                            phase),
+                                     excitation_phase=phase)
+        # up to the mixing products of the other tones
+        assert np.isclose(tone.FHarmonic, single.FHarmonic, rtol=1e-2)
+        assert np.isclose(tone.FHarmonic_phase,
+                          single.FHarmonic_phase,
+                          atol=1e-2)
+
+
+def test_junction_log_reuses_its_buffer(simulation_input):
+    org_layers = simulation_input().layers
+    org_layer_strs = [str(layer.layer) for layer in org_layers]
+    junction = build_junction(org_layers)
+    junction_log = JunctionLog(org_layer_strs)
+    int_step = 1e-12
+    buffers = []
+    # the longest run first, the shorter one read into its first steps
+    for steps in (200, 120):
+        junction.clearLog()
+        junction.runSimulation(steps * int_step, int_step, int_step)
+        log = junction.getLog()
+        m = junction_log.read(junction)
+        assert m.shape == (len(org_layers), 3, len(log['time']))
+        assert np.allclose(junction_log.time, log['time'])
+        for i, layer in enumerate(org_layer_strs):
+            for j, axis in enumerate("xyz"):
+                assert np.allclose(m[i, j], log[f"{layer}_m{axis}"])
+        buffers.append(m)
+    assert np.shares_memory(*buffers)
+
+
+def test_multitone_only_past_the_break_even(monkeypatch, simulation_input):
+    tiny = simulation_input(HSteps=2, fmin=2., fmax=6., fsteps=3,
+                            LLGtime=1., LLGsteps=1000)
+    reference = run(tiny)
+    monkeypatch.setattr(DataConfig, "VSD_MULTITONE", True)
+    monkeypatch.setattr(DataConfig, "VSD_MULTITONE_MIN_TONES", 4)
+    # too few tones, they're run one by one
+    assert np.array_equal(run(tiny).Rxx_vsd.DC, reference.Rxx_vsd.DC)
+    monkeypatch.setattr(DataConfig, "VSD_MULTITONE_MIN_TONES", 3)
+    assert not np.array_equal(run(tiny).Rxx_vsd.DC, reference.Rxx_vsd.DC)
+
+
+def test_streamed_relaxation_runs_all_steps(monkeypatch, simulation_input):
+    tiny = simulation_input(HSteps=3, fsteps=0, LLGtime=2., LLGsteps=2000)
+    monkeypatch.setattr(DataConfig, "PIMM_STREAM_SEGMENT_STEPS", 0)
+    reference = run(tiny)
+    monkeypatch.setattr(DataConfig, "PIMM_STREAM_SEGMENT_STEPS", 700)
+    assert relaxation_segments(tiny.stimulus) == [700, 700, 600]
+    streamed = run(tiny)
+    # the remainder is run too, the relaxation ends in the same state
+    assert np.allclose(streamed.m_avg, reference.m_avg)
+    # the spectrum has the resolution of a segment
+    assert streamed.PIMM.shape == (3, 43)
+
+
+def test_streamed_relaxation_mean_spectrum_full_trajectory(
+        monkeypatch, simulation_input, tmp_path):
+    tiny = simulation_input(HSteps=3, fsteps=0, LLGtime=2., LLGsteps=2000)
+    tiny.layers = tiny.layers[:1]
+    tiny.layers[0].alpha = 0.2
+    monkeypatch.setattr(DataConfig, "PIMM_STREAM_SEGMENT_STEPS", 700)
+    monkeypatch.setattr(DataConfig, "TRAJECTORY_STORE_DIR", str(tmp_path))
+    streamed = run(tiny)
+    # relaxed, the DC bin is that of a single segment, whatever their count
+    assert np.isclose(streamed.PIMM[0, 0],
+                      700 * tiny.layers[0].Ms * abs(streamed.m_avg[0, 2]),
+                      rtol=1e-2)
+    # the short last segment fills the whole stored row
+    for H_indx in range(3):
+        assert np.allclose(
+            np.linalg.norm(streamed.m_traj[H_indx], axis=1), 1, atol=1e-4)
+
+
+def test_adaptive_frequencies_refine_at_a_step(monkeypatch):
+    monkeypatch.setattr(DataConfig, "VSD_ADAPTIVE_FREQUENCIES", 16)
+    frequency_steps, edge = 61, 37
+    vsd = VoltageSpinDiodeData.empty(1, frequency_steps)
+    order = []
+    for f_indx in adaptive_frequency_indices(vsd, frequency_steps):
+        order.append(f_indx)
+        value = float(f_indx >= edge)
+        vsd.write(
+            0, f_indx,
+            VoltageSpinDiodeData(DC=value,
+                                 FHarmonic=value,
+                                 SHarmonic=0.,
+                                 FHarmonic_phase=0.,
+                                 SHarmonic_phase=0.))
+    assert len(order) == len(set(order)) == 16
+    # the coarse grid, then the step bracketed down to its neighbours
+    assert order[:8] == [0, 9, 17, 26, 34, 43, 51, 60]
+    assert {edge - 1, edge}.issubset(order[8:11])
+
+
+def test_adaptive_frequencies_marked_simulated(monkeypatch, simulation_input):
+    tiny = simulation_input(HSteps=2, fmin=2., fmax=9., fsteps=8,
+                            LLGtime=1., LLGsteps=1000)
+    monkeypatch.setattr(DataConfig, "VSD_ADAPTIVE_FREQUENCIES", 5)
+    result = run(tiny)
+    for vsd in (result.Rxx_vsd, result.Rxy_vsd):
+        assert np.array_equal(vsd.simulated.sum(axis=1), [5, 5])
+        # the others interpolated
+        assert not np.isnan(vsd.DC).any()
+        assert np.array_equal(vsd.simulated[:, [0, -1]], np.ones((2, 2)))
+
+
+def test_relaxation_stops_early_once_relaxed(monkeypatch, simulation_input):
+    tiny = simulation_input(HSteps=3, fsteps=0, LLGtime=4., LLGsteps=4000)
+    for layer in tiny.layers:
+        layer.alpha = 0.2
+    steps = []
+    read = JunctionLog.read
+
+    def counted_read(self, junction):
+        m = read(self, junction)
+        steps.append(m.shape[-1])
+        return m
+
+    monkeypatch.setattr(JunctionLog, "read", counted_read)
+    reference = run(tiny)
+    assert sum(steps) == 3 * 4000
+    steps.clear()
+    monkeypatch.setattr(DataConfig, "RELAXATION_DMDT_TOLERANCE", 1e6)
+    early = run(tiny)
+    assert sum(steps) < 3 * 4000
+    # relaxed, the same static results and spectrum shape
+    assert np.allclose(early.m_avg, reference.m_avg)
+    assert np.allclose(early.Rx, reference.Rx)
+    assert early.PIMM.shape == reference.PIMM.shape
+
+
+def test_concurrent_chains_match_serial(monkeypatch, simulation_input):
+    tiny = simulation_input(HSteps=4, fmin=2., fmax=6., fsteps=3,
+                            LLGtime=1., LLGsteps=1000)
+    serial = run(tiny)
+    monkeypatch.setattr(DataConfig, "CONCURRENT_PIMM_VSD", True)
+    concurrent = run(tiny)
+    # the VSD chain carries its own state in its own process
+    assert np.array_equal(concurrent.m_avg, serial.m_avg)
+    assert np.array_equal(concurrent.PIMM, serial.PIMM)
+    for name in ("Rxx_vsd", "Rxy_vsd"):
+        assert np.array_equal(getattr(concurrent, name).DC,
+                              getattr(serial, name).DC)
+        assert np.array_equal(getattr(concurrent, name).SHarmonic,
+                              getattr(serial, name).SHarmonic)
+
+
+def test_segmented_sweep_matches_serial(monkeypatch, simulation_input):
+    tiny = simulation_input(HSteps=6, HBack=1, fmin=2., fmax=6., fsteps=2,
+                            LLGtime=1., LLGsteps=1000)
+    # a damped single layer relaxes within LLG_time, so the seeded
+    # segments continue from the same states as the serial sweep
+    tiny.layers = tiny.layers[:1]
+    tiny.layers[0].alpha = 0.2
+    serial = run(tiny)
+    monkeypatch.setattr(DataConfig, "H_SWEEP_SEGMENTS", 3)
+    segmented = run(tiny)
+    assert segmented.filled == serial.filled == 12
+    assert segmented.H_mag == serial.H_mag
+    assert np.allclose(segmented.m_avg, serial.m_avg, atol=1e-6)
+    assert np.allclose(segmented.PIMM, serial.PIMM, rtol=1e-6)
+    assert np.allclose(segmented.Rxx_vsd.DC, serial.Rxx_vsd.DC, rtol=1e-6)
+
+
+def serial_runs(monkeypatch) -> list:
+    """
+    H indices of every simulate call made in this process,
+    the seeded segments run in the pool are not recorded
+    """
+    calls = []
+    simulate = solver.simulate
+
+    def recorded(*args, **kwargs):
+        calls.append(kwargs.get("H_indices"))
+        return simulate(*args, **kwargs)
+
+    monkeypatch.setattr(solver, "simulate", recorded)
+    return calls
+
+
+def test_segmented_sweep_without_sd_frequencies(monkeypatch,
+                                                simulation_input):
+    tiny = simulation_input(HSteps=6, HBack=1, fsteps=0, LLGtime=1.,
+                            LLGsteps=1000)
+    tiny.layers = tiny.layers[:1]
+    tiny.layers[0].alpha = 0.2
+    serial = run(tiny)
+    monkeypatch.setattr(DataConfig, "H_SWEEP_SEGMENTS", 3)
+    calls = serial_runs(monkeypatch)
+    segmented = run(tiny)
+    # the VSD chain stays at the initial magnetisation, as seeded,
+    # so only the first segment is run here
+    assert calls == [range(0, 3)]
+    assert np.allclose(segmented.m_avg, serial.m_avg, atol=1e-6)
+    assert np.allclose(segmented.PIMM, serial.PIMM, rtol=1e-6)
+
+
+def test_segmented_sweep_falls_back_to_serial(monkeypatch,
+                                              simulation_input):
+    # the weakly damped preset stack doesn't relax within LLG_time,
+    # the seeds disagree at every boundary
+    tiny = simulation_input(HSteps=6, HBack=1, fsteps=0, LLGtime=1.,
+                            LLGsteps=1000)
+    serial = run(tiny)
+    monkeypatch.setattr(DataConfig, "H_SWEEP_SEGMENTS", 3)
+    calls = serial_runs(monkeypatch)
+    segmented = run(tiny)
+    # the first segment, the re-run of the second one and the rest
+    assert calls == [range(0, 3), range(3, 6), range(6, 12)]
+    assert np.allclose(segmented.m_avg, serial.m_avg, atol=1e-6)
+    assert np.allclose(segmented.PIMM, serial.PIMM, rtol=1e-6)
+
+
+def test_segmented_fallback_stops_the_seeded_segments(monkeypatch,
+                                                      simulation_input):
+    # the segments run on threads here, so that the later ones can be
+    # slowed down, they're still running when the re-run starts
+    tiny = simulation_input(HSteps=6, HBack=1, fsteps=0, LLGtime=1.,
+                            LLGsteps=1000)
+    executor = ThreadPoolExecutor(max_workers=3,
+                                  initializer=solver._init_worker,
+                                  initargs=(DataConfig.snapshot(), None,
+                                            threading.Event()))
+    futures = []
+    submit = executor.submit
+
+    def recorded_submit(*args, **kwargs):
+        futures.append(submit(*args, **kwargs))
+        return futures[-1]
+
+    monkeypatch.setattr(executor, "submit", recorded_submit)
+    handle_signals = lambda: 1
+    done_at_rerun = []
+    simulate = solver.simulate
+
+    def slowed(*args, **kwargs):
+        H_indices = kwargs.get("H_indices")
+        if args[1] is handle_signals:
+            if H_indices == range(3, 6):
+                done_at_rerun.extend(future.done() for future in futures)
+        elif H_indices.start >= 6:
+            for partial_result in simulate(*args, **kwargs):
+                time.sleep(1.)
+                yield partial_result
+            return
+        yield from simulate(*args, **kwargs)
+
+    monkeypatch.setattr(solver, "simulate", slowed)
+    try:
+        results = list(
+            solver.simulate_segmented(tiny,
+                                      handle_signals,
+                                      executor=executor,
+                                      segments=3))
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+    assert len(results) == 12
+    # the seeded segments had returned before the re-run started
+    assert len(done_at_rerun) == 3 and all(done_at_rerun)
+    # the slowed ones were stopped on the way
+    for future in futures[1:]:
+        assert len(future.result()[0]) < 3
+
+
+def test_stopped_segment_returns(simulation_input):
+    tiny = simulation_input(HSteps=3, fsteps=0, LLGtime=1., LLGsteps=1000)
+    solver._init_worker(DataConfig.snapshot(), None, mp.Event())
+    stop = SharedFlag.create()
+    state = solver.SweepState(m_PIMM=None, m_VSD=None)
+    results, _ = solver._segment_worker(tiny, range(0, 3), state, None, stop)
+    assert len(results) == 3
+    # picklable, the copy sees the flag set
+    pickle.loads(pickle.dumps(stop)).set()
+    assert stop.is_set()
+    state = solver.SweepState(m_PIMM=None, m_VSD=None)
+    results, _ = solver._segment_worker(tiny, range(0, 3), state, None, stop)
+    assert results == []
+
+
+def test_PIMM_spectrum_written_in_place(monkeypatch, simulation_input):
+    spectrum = PIMMSpectrum(1000, 1e-12)
+    mixed = np.sin(2 * np.pi * 7e9 * np.arange(1000) * 1e-12)
+    out = np.empty(len(spectrum.freqs), dtype=np.float32)
+    assert spectrum(mixed, out=out) is out
+    assert np.array_equal(out, spectrum(mixed))
+    # every partial result owns its row, unless only the peaks are kept
+    tiny = simulation_input(HSteps=3, fsteps=0, LLGtime=1., LLGsteps=1000)
+    rows = [partial_result.PIMM[0]
+            for partial_result in solver.simulate(tiny, lambda: 1)]
+    assert not any(np.shares_memory(rows[0], row) for row in rows[1:])
+    reference = run(tiny)
+    monkeypatch.setattr(DataConfig, "PIMM_PEAKS", 2)
+    peaks = run(tiny).PIMM_peaks
+    for H_indx in range(3):
+        assert np.array_equal(
+            peaks[H_indx],
+            PIMM_peaks(reference.PIMM[H_indx], reference.PIMM_freqs, 2),
+            equal_nan=True)
+
+
+def test_PIMM_zoom_band_resolves_the_peak(monkeypatch):
+    # 1 GHz apart rfft bins, against 512 points inside the band
+    steps, int_step = 1000, 1e-12
+    frequency = 5.37e9
+    time = np.arange(steps) * int_step
+    mixed = np.exp(-time / 5e-10) * np.sin(2 * np.pi * frequency * time)
+    monkeypatch.setattr(DataConfig, "PIMM_ZOOM_BAND_GHZ", None)
+    full = PIMMSpectrum(steps, int_step)
+    monkeypatch.setattr(DataConfig, "PIMM_ZOOM_BAND_GHZ", (4, 7))
+    zoom = PIMMSpectrum(steps, int_step)
+    assert len(zoom.freqs) == DataConfig.PIMM_ZOOM_POINTS
+    assert zoom.freqs[0] == 4e9 and zoom.freqs[-1] == 7e9
+    full_error = abs(full.freqs[np.argmax(full(mixed))] - frequency)
+    zoom_error = abs(zoom.freqs[np.argmax(zoom(mixed))] - frequency)
+    assert zoom_error < 0.05e9 < full_error
+    # the zoom samples the same spectrum as the bins it falls on
+    spectrum = zoom(mixed)
+    assert np.isclose(np.interp(5e9, zoom.freqs, spectrum),
+                      full(mixed)[np.argmin(np.abs(full.freqs - 5e9))],
+                      rtol=1e-2)
+
+
+def test_PIMM_peaks_between_bins():
+    pimm_freqs = np.arange(200) * 0.1
+    # Lorentzians between the bins, the weaker one wider
+    spectrum = (1 / (1 + ((pimm_freqs - 5.03) / 0.2)**2) + 0.5 /
+                (1 + ((pimm_freqs - 12.46) / 0.4)**2))
+    peaks = PIMM_peaks(spectrum, pimm_freqs, 3)
+    assert peaks.shape == (3, 3)
+    assert np.allclose(peaks[:2, 0], [5.03, 12.46], atol=0.02)
+    assert np.allclose(peaks[:2, 1], [1, 0.5], rtol=0.05)
+    assert np.allclose(peaks[:2, 2], [0.4, 0.8], rtol=0.1)
+    # fewer peaks than asked for
+    assert np.isnan(peaks[2]).all()
+    assert np.isnan(PIMM_peaks(np.ones(10), np.arange(10), 2)).all()
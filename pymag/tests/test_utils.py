@@ -0,0 +1,72 @@
+import numpy as np
+from scipy.fft import rfft
+from scipy.signal import butter, lfilter
+
+from pymag.engine.utils import (butter_lowpass_filter, butter_sos,
+                                harmonic_bins, split_sweep)
+
+
+def test_harmonic_bins_around_harmonics():
+    integration_step = 1e-12
+    frequency = 3.3e9
+    N = 3000
+    time = np.arange(N) * integration_step
+    data = np.sin(2 * np.pi * frequency * time) + 0.1 * np.sin(
+        4 * np.pi * frequency * time)
+    bins = harmonic_bins(frequency, N, integration_step, harmonics=(1, 2, 3))
+    assert bins.shape == (3, 5)
+    # centred on the closest bins, the peaks are inside
+    assert np.array_equal(bins[:, 2], np.rint([9.9, 19.8, 29.7]))
+    spectrum = np.abs(rfft(data))
+    for harmonic in (0, 1):
+        strongest = np.argmax(spectrum[bins[harmonic]])
+        assert bins[harmonic, strongest] == bins[harmonic, 2]
+    # kept inside the one-sided spectrum
+    assert harmonic_bins(0, N, integration_step).min() == 0
+    assert harmonic_bins(0.5 / integration_step, N,
+                         integration_step).max() < N // 2
+
+
+def test_harmonic_bins_of_a_short_series():
+    # fewer one-sided bins than the neighbourhood
+    for N in range(1, 10):
+        bins = harmonic_bins(2e9, N, 1e-10, harmonics=(1, 2, 3))
+        assert bins.shape == (3, 5)
+        assert bins.min() >= 0 and bins.max() <= N // 2, N
+
+
+def test_butter_lowpass_filter_cached_and_stacked():
+    fs = 1e12
+    time = np.arange(4000) / fs
+    data = np.stack((np.sin(2 * np.pi * 2e9 * time),
+                     1 + np.sin(2 * np.pi * 5e10 * time)))
+    butter_sos.cache_clear()
+    stacked = butter_lowpass_filter(data, cutoff=10e9, fs=fs, order=3)
+    for channel in range(len(data)):
+        single = butter_lowpass_filter(data[channel],
+                                       cutoff=10e9,
+                                       fs=fs,
+                                       order=3)
+        assert np.allclose(stacked[channel], single)
+    # designed once for all the calls
+    info = butter_sos.cache_info()
+    assert info.misses == 1 and info.hits == len(data)
+    # the same response as the transfer function form
+    b, a = butter(3, 10e9 / (0.5 * fs), btype='low')
+    assert np.allclose(stacked, lfilter(b, a, data, axis=-1))
+
+
+def test_split_sweep_keeps_branches_apart():
+    forward = np.linspace(-1, 1, 6)[:, np.newaxis] * [1, 0, 0]
+    H_ranges = split_sweep(np.concatenate((forward, -forward)), 3)
+    # the ranges cover the sweep in order, none of them across the turn
+    assert [i for H_range in H_ranges for i in H_range] == list(range(12))
+    assert all(H_range.stop <= 6 or H_range.start >= 6
+               for H_range in H_ranges)
+    assert len(H_ranges) == 4
+
+
+def test_split_sweep_single_branch():
+    H_sweep = np.linspace(0, 1, 5)[:, np.newaxis] * [1, 0, 0]
+    assert split_sweep(H_sweep, 1) == [range(0, 5)]
+    assert split_sweep(H_sweep, 10) == [range(i, i + 1) for i in range(5)]